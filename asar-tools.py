@@ -3,26 +3,50 @@
 from httplib2 import Http
 from urlparse import urlparse, urljoin
 from BeautifulSoup import BeautifulSoup
+import urllib
 import urllib2
+import httplib
+import socket
+import threading
+import Queue
+import multiprocessing
+import time
 import shutil
+import json
 import logging
 import re
 import os
+import mmap
+import struct
+import math
+import hashlib
+import hmac
+import base64
+import mimetypes
+from email.utils import formatdate
 from string import Template
+from StringIO import StringIO
 from tempfile import mkdtemp
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 from datetime import datetime, timedelta   
+from contextlib import contextmanager
 import psycopg2
 from psycopg2.extras import RealDictCursor, register_uuid
 
 from S3.Exceptions import *
-from S3.S3 import S3
 from S3.Config import Config
 from S3.S3Uri import S3Uri
 
 import settings
 
 
+# each thread gets its own autocommit connection from a shared pool, which goes back to the 
+# pool once the thread has finished
+# a thread never waits for a connection - one is opened if none is idle - and up to 
+# pool_size idle connections are kept open, with their prepared statements, for reuse
+# statements registered with prepare() are prepared on each connection the first time they 
+# are run there, and run with execute()
 class GeoDatabase:
     
     def __init__(self):
@@ -30,31 +54,143 @@ class GeoDatabase:
         self.user = settings.GEO_DB_USER
         self.passwd = settings.GEO_DB_PASS
         self.dbname = settings.GEO_DB_DATABASE
-        self.db = None
+        self.idle = None
+        # by default enough for every thread the busiest command runs at once
+        self.pool_size = getattr(settings, 'DB_POOL_SIZE', None) or (2 + 
+            getattr(settings, 'DOWNLOAD_WORKERS', 4) + 
+            getattr(settings, 'PIPELINE_PROCESS_WORKERS', 2) + 
+            getattr(settings, 'PUBLISH_WORKERS', 2))
+        self.local = threading.local()
+        self.owners = {}
+        self.statements = {}
+        self.prepared = {}
+        self.itersize = getattr(settings, 'DB_ITERSIZE', 2000)
+        self.cursor_count = 0
+        self.lock = threading.Lock()
         psycopg2.extras.register_uuid()
         
     def connect (self):        
         try:
-            self.db = psycopg2.connect (
-                host = self.host, 
-                user = self.user, 
-                password = self.passwd,
-                database = self.dbname
-                )
-            self.db.autocommit = True    
+            self.idle = Queue.LifoQueue()
+            self.connection ()
             logging.info ("Connected to database %s" % self.host)
             logging.debug ("  user: %s database %s" % (self.user, self.dbname))
         except psycopg2.Error, e:
-            self.db = None
+            self.idle = None
             logging.error ("Unable to connect to database: Error %d: %s" % 
                 (e.args[0], e.args[1]))
             raise 
     
+    def _open (self):
+        conn = psycopg2.connect (
+            host = self.host, 
+            user = self.user, 
+            password = self.passwd,
+            database = self.dbname
+            )
+        conn.autocommit = True    
+        return conn
+    
+    # keep a connection for reuse, or close it if it's broken or enough are idle already
+    def _release (self, conn):
+        if not conn.closed and self.idle.qsize() < self.pool_size:
+            self.idle.put (conn)
+            return
+        self.prepared.pop(conn, None)
+        if not conn.closed:
+            conn.close ()
+    
+    def close (self):
+        if self.idle:
+            while not self.idle.empty():
+                self.idle.get().close ()
+            self.idle = None
+    
+    # the calling thread's connection
+    def connection (self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None and not conn.closed:
+            return conn
+        
+        with self.lock:
+            # take back connections from threads that have finished, and drop broken ones
+            for t in self.owners.keys():
+                if not t.is_alive() or self.owners[t].closed:
+                    self._release (self.owners.pop(t))
+            try:
+                conn = self.idle.get_nowait ()
+            except Queue.Empty:
+                conn = self._open ()
+            self.owners[threading.current_thread()] = conn
+        self.local.conn = conn
+        return conn
+    
     def cursor (self):
-        return self.db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        return self.connection().cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    
+    # register a statement to be run with execute(), with %s placeholders for its parameters
+    def prepare (self, name, sql):
+        self.statements[name] = sql
+    
+    # run a prepared statement, returning the cursor
+    def execute (self, name, params = None):
+        params = params or []
+        conn = self.connection()
+        c = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        
+        prepared = self.prepared.setdefault(conn, set())
+        if name not in prepared:
+            count = [0]
+            def placeholder (match):
+                if match.group(1) == '%':
+                    return '%'
+                count[0] += 1
+                return '$%s' % count[0]
+            c.execute ('prepare %s as %s' % (name, re.sub('%(%|s)', placeholder, self.statements[name])))
+            prepared.add (name)
+        
+        if params:
+            c.execute ('execute %s (%s)' % (name, ','.join(['%s'] * len(params))), params)
+        else:
+            c.execute ('execute %s' % name)
+        return c
+    
+    # run a query on a named server-side cursor and yield its rows, fetching itersize rows 
+    # at a time, so large results never have to fit in memory and the first rows arrive 
+    # before the query has finished
+    # the cursor lives in a transaction on the calling thread's connection until the rows run 
+    # out, so don't write through that connection while iterating
+    def stream (self, sql, params = None, itersize = None):
+        with self.lock:
+            self.cursor_count += 1
+            name = 'stream_%s' % self.cursor_count
+        with self.transaction () as cur:
+            c = cur.connection.cursor(name, cursor_factory=psycopg2.extras.RealDictCursor)
+            c.itersize = itersize or self.itersize
+            try:
+                c.execute (sql, params)
+                for row in c:
+                    yield row
+            finally:
+                c.close ()
+    
+    # run a block in one transaction on the calling thread's connection, committing if it 
+    # completes and rolling back if it raises
+    @contextmanager
+    def transaction (self):
+        conn = self.connection()
+        conn.autocommit = False
+        try:
+            yield conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            conn.commit ()
+        except:
+            conn.rollback ()
+            raise
+        finally:
+            conn.autocommit = True
 
     def exec_sql (self, sql, params = None):
-        c = self.db.cursor() 
+        c = self.connection().cursor() 
         if params:
             c.execute(sql, params)
         else:
@@ -62,17 +198,25 @@ class GeoDatabase:
         return c.rowcount
                 
     def item_exists (self, table, match_fields):
-        where_sql = ' and '.join(["%s='%s'" %(k,v) for k,v in match_fields.items()])
-        c = self.db.cursor() 
-        c.execute('select * from %s where %s' % (table, where_sql))
+        where_sql = ' and '.join(["%s=%%s" %(k) for k in match_fields.keys()])
+        c = self.connection().cursor() 
+        c.execute('select 1 from %s where %s limit 1' % (table, where_sql), match_fields.values())
         return c.rowcount > 0
 
+    # returns the set of the given values that are already present in a field of the table
+    def existing_values (self, table, field, values):
+        if not values:
+            return set()
+        c = self.connection().cursor() 
+        c.execute('select %s from %s where %s = any(%%s)' % (field, table, field), [list(values)])
+        return set([row[0] for row in c.fetchall()])
+
     def load_item (self, table, match_fields):
         return self.load_items (table, match_fields, limit=1)
 
     def load_items (self, table, match_fields, limit = None):
         where_sql = ' and '.join(["%s=%%s" %(k) for k in match_fields.keys()])
-        c = self.db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        c = self.cursor()
         limit_sql = ''
         if limit:
             limit_sql = 'limit %s' % limit
@@ -88,24 +232,255 @@ class GeoDatabase:
 
         sql = "INSERT INTO %s (%s) VALUES (%s)" % (table.lower(), key_str, value_str)
         values = fields.values()
-        c = self.db.cursor()
+        c = self.connection().cursor()
 #        print c.mogrify(sql, values)
         c.execute (sql, values)
         return c.lastrowid
+
+    # insert a list of rows with a single multi-row INSERT, so either all rows are added or none
+    # all rows must have the same fields
+    # returns the number of rows inserted
+    def insert_items (self, table, items):
+        if not items:
+            return 0
+        keys = items[0].keys()
+        row_sql = '(%s)' % ','.join(['%s'] * len(keys))
+        c = self.connection().cursor()
+        values_sql = ','.join([c.mogrify(row_sql, [item[k] for k in keys]) for item in items])
+        
+        sql = "INSERT INTO %s (%s) VALUES %s" % (table.lower(), ','.join(keys), values_sql)
+        c.execute (sql)
+        return c.rowcount
         
 
 def removeNBSP (str):
     regex = re.compile(re.escape('&nbsp;'), re.IGNORECASE)
     return regex.sub(' ', str)
 
+# move src over dst, replacing dst if it exists
+def replace_file (src, dst):
+    if os.name == 'nt' and os.path.exists(dst):
+        os.unlink(dst)
+    os.rename(src, dst)
+
+# clip a polygon, given as a list of (x, y) points, to a box with the Sutherland-Hodgman 
+# algorithm, returning the points of the clipped polygon (empty if they don't overlap)
+def clip_to_box (points, west, south, east, north):
+    edges = [
+        (lambda p: p[0] >= west, lambda a, b: (west, a[1] + (b[1] - a[1]) * (west - a[0]) / (b[0] - a[0]))),
+        (lambda p: p[0] <= east, lambda a, b: (east, a[1] + (b[1] - a[1]) * (east - a[0]) / (b[0] - a[0]))),
+        (lambda p: p[1] >= south, lambda a, b: (a[0] + (b[0] - a[0]) * (south - a[1]) / (b[1] - a[1]), south)),
+        (lambda p: p[1] <= north, lambda a, b: (a[0] + (b[0] - a[0]) * (north - a[1]) / (b[1] - a[1]), north)),
+    ]
+    for inside, crossing in edges:
+        if not points:
+            break
+        clipped = []
+        prev = points[-1]
+        for p in points:
+            if inside(p):
+                if not inside(prev):
+                    clipped.append (crossing(prev, p))
+                clipped.append (p)
+            elif inside(prev):
+                clipped.append (crossing(prev, p))
+            prev = p
+        points = clipped
+    return points
+
+# clip a polygon to a convex polygon, both given as lists of (x, y) points, with the same 
+# Sutherland-Hodgman algorithm, returning the points of the clipped polygon
+def clip_to_convex (points, convex):
+    if convex and convex[0] == convex[-1]:
+        convex = convex[:-1]
+    # the clip edges are walked so that the inside is on their left
+    area = sum([convex[i - 1][0] * convex[i][1] - convex[i][0] * convex[i - 1][1] for i in range(len(convex))])
+    if area < 0:
+        convex = convex[::-1]
+    for i in range(len(convex)):
+        a, b = convex[i - 1], convex[i]
+        def side (p):
+            return (b[0] - a[0]) * (p[1] - a[1]) - (b[1] - a[1]) * (p[0] - a[0])
+        def crossing (p, q):
+            t = float(side(p)) / (side(p) - side(q))
+            return (p[0] + (q[0] - p[0]) * t, p[1] + (q[1] - p[1]) * t)
+        if not points:
+            break
+        clipped = []
+        prev = points[-1]
+        for p in points:
+            if side(p) >= 0:
+                if side(prev) < 0:
+                    clipped.append (crossing(prev, p))
+                clipped.append (p)
+            elif side(prev) >= 0:
+                clipped.append (crossing(prev, p))
+            prev = p
+        points = clipped
+    return points
+
+
+# on-disk cache of the last listing seen from each mirror, keyed by mirror url
+# each entry holds the ETag and Last-Modified validators and the image names in the listing
+# new entries are staged during a scrape and only written out by commit(), so a scrape that 
+# fails before its records reach the database will see the same rows again next time
+class ListingCache:
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.pending = {}
+        self.name_sets = None
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            try:
+                f = open(filename, 'r')
+                try:
+                    self.entries = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError), e:
+                logging.warning ('Ignoring unreadable listing cache %s: %s' % (filename, e))
+                
+    def get (self, url):
+        return self.entries.get(url, {})
+    
+    # urls of all the listings in which the named image was last seen
+    def listed_by (self, name):
+        with self.lock:
+            if self.name_sets is None:
+                self.name_sets = dict([(url, set(entry.get('names', []))) for url, entry in self.entries.items()])
+            return [url for url, names in self.name_sets.items() if name in names]
+        
+    def stage (self, url, entry):
+        with self.lock:
+            self.pending[url] = entry
+            
+    def commit (self):
+        with self.lock:
+            if not self.pending:
+                return
+            self.entries.update (self.pending)
+            self.pending = {}
+            self.name_sets = None
+            
+            tempfile = '%s.tmp' % self.filename
+            f = open(tempfile, 'w')
+            try:
+                json.dump(self.entries, f)
+            finally:
+                f.close()
+            replace_file (tempfile, self.filename)
+            logging.debug ('Saved listing cache to %s' % self.filename)
+        
+        
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+
+
+# token bucket that caps the combined rate of several transfers, in bytes per second
+class BandwidthLimiter:
+    def __init__ (self, rate):
+        self.rate = float(rate)
+        self.allowance = self.rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+    
+    # account for nbytes just transferred, sleeping long enough to stay under the rate
+    def consume (self, nbytes):
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance + (now - self.last) * self.rate)
+            self.last = now
+            self.allowance -= nbytes
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep (wait)
+        
+
+# per-mirror transfer statistics gathered from real downloads and persisted between runs
+# throughput (bytes/sec), latency (seconds to the first response) and error rate are all 
+# exponentially weighted moving averages, so a mirror's score follows its recent behaviour
+class MirrorHealth:
+    # weight given to the newest observation
+    alpha = 0.3
+    
+    def __init__ (self, filename = None):
+        self.filename = filename
+        self.hosts = {}
+        self.lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            try:
+                f = open(filename, 'r')
+                try:
+                    self.hosts = json.load(f)
+                finally:
+                    f.close()
+            except (IOError, ValueError), e:
+                logging.warning ('Ignoring unreadable mirror health file %s: %s' % (filename, e))
+    
+    def _average (self, old, new):
+        if old is None:
+            return new
+        return old + self.alpha * (new - old)
+    
+    def _host (self, host):
+        return self.hosts.setdefault(host, {'throughput': None, 'latency': None, 'error_rate': 0.0, 
+            'transfers': 0, 'failures': 0})
+    
+    def record_success (self, host, nbytes, seconds, latency):
+        with self.lock:
+            h = self._host(host)
+            h['throughput'] = self._average(h['throughput'], nbytes / max(seconds, 0.001))
+            h['latency'] = self._average(h['latency'], latency)
+            h['error_rate'] = self._average(h['error_rate'], 0.0)
+            h['transfers'] += 1
+    
+    def record_failure (self, host):
+        with self.lock:
+            h = self._host(host)
+            h['error_rate'] = self._average(h['error_rate'], 1.0)
+            h['failures'] += 1
+    
+    # expected seconds to fetch size_bytes from host, allowing for failed attempts
+    # returns None for a host that has never been used
+    def expected_time (self, host, size_bytes):
+        h = self.hosts.get(host)
+        if not h or not (h['transfers'] or h['failures']):
+            return None
+        if not h['throughput'] or h['error_rate'] >= 1.0:
+            return float('inf')
+        return ((h['latency'] or 0) + float(size_bytes or 0) / h['throughput']) / (1.0 - h['error_rate'])
+    
+    # hosts ordered from best to worst for a transfer of size_bytes
+    # hosts without any history come first so that every mirror gets measured
+    def rank (self, hosts, size_bytes = None):
+        def key (host):
+            t = self.expected_time(host, size_bytes)
+            return (t is not None, t)
+        return sorted(hosts, key=key)
+    
+    def save (self):
+        if not self.filename:
+            return
+        with self.lock:
+            tempfile = '%s.tmp' % self.filename
+            f = open(tempfile, 'w')
+            try:
+                json.dump(self.hosts, f)
+            finally:
+                f.close()
+            replace_file (tempfile, self.filename)
+        
+
 class ESARollingArchive:
     urls = ['https://oa-es.eo.esa.int/ra/asa/index.php', 
             'https://oa-ks.eo.esa.int/ra/asa/index.php',
             'https://oa-ip.eo.esa.int/ra/asa/index.php' ]
     user = 'asausr'
     password = 'asa1sra'
+    cache = None
+    health = None
   
-    def __init__(self, debug = False):
+    def __init__(self, debug = False, cache_file = None, health_file = None):
         passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
         for url in self.urls:
             p = urlparse (url)
@@ -113,13 +488,69 @@ class ESARollingArchive:
             
         urllib2.install_opener(urllib2.build_opener(urllib2.HTTPBasicAuthHandler(passman), urllib2.HTTPSHandler(debuglevel=1)))
         
+        if cache_file:
+            self.cache = ListingCache (cache_file)
+        self.health = MirrorHealth (health_file)
     
-    def scrape (self):
+    # scrape all mirrors and return the merged list of records
+    # with concurrent=True each mirror is fetched and parsed in its own thread, and any 
+    # mirror that has not finished within timeout seconds is dropped from the result
+    # when a listing cache is in use only records not seen in the previous listing are returned
+    # unless full=True; call commit() once the returned records have been stored
+    def scrape (self, concurrent = True, timeout = None, full = False):
+        if timeout is None:
+            timeout = getattr(settings, 'SCRAPE_TIMEOUT', 120)
+        
+        results = {}
+        if not concurrent:
+            for url in self.urls:
+                self._scrape_worker (url, timeout, full, results)
+        else:
+            threads = []
+            for url in self.urls:
+                t = threading.Thread (target=self._scrape_worker, args=(url, timeout, full, results))
+                # a stalled mirror must not keep the process alive
+                t.daemon = True
+                t.start ()
+                threads.append (t)
+            
+            deadline = time.time() + timeout
+            for t in threads:
+                t.join (max(0, deadline - time.time()))
+        
         records = []
         for url in self.urls:
-            records.extend (self.scrape_page(url))
+            if url not in results:
+                logging.warning ('Timed out after %ss scraping %s' % (timeout, url))
+                continue
+            mirror_records, cache_entry = results[url]
+            if mirror_records is not None:
+                records.extend (mirror_records)
+            # only listings that made it into the result are remembered
+            if cache_entry is not None and self.cache:
+                self.cache.stage (url, cache_entry)
         return records
     
+    # write the listings from the last scrape to the listing cache
+    def commit (self):
+        if self.cache:
+            self.cache.commit ()
+    
+    def _scrape_worker (self, url, timeout, full, results):
+        results[url] = self.scrape_mirror (url, timeout, full)
+        
+    # scrape a single mirror, returns a tuple of (records, cache_entry)
+    # records is None if the mirror could not be scraped, cache_entry is None if nothing should 
+    # be stored for this mirror
+    def scrape_mirror (self, url, timeout = None, full = False):
+        try:
+            return self.scrape_page (url, timeout, full)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            logging.error ('Failed scraping %s: %s' % (url, e))
+        except Exception, e:
+            logging.error ('Failed parsing listing from %s: %s' % (url, e))
+        return None, None
+    
     def clean (self, str):
         return removeNBSP(str).strip()
     
@@ -133,14 +564,33 @@ class ESARollingArchive:
         parts['orbit'] = int (name[49:54])
         return parts
         
-    def scrape_page (self, url):
+    def scrape_page (self, url, timeout = None, full = False):
         logging.info ('Scraping image data from: %s' % url)
         
+        request = urllib2.Request(url)
+        cached = {}
+        if self.cache and not full:
+            cached = self.cache.get(url)
+            if cached.get('etag'):
+                request.add_header('If-None-Match', cached['etag'])
+            if cached.get('last_modified'):
+                request.add_header('If-Modified-Since', cached['last_modified'])
+        
 #        f = open('data/esa_rolling_archive.html', 'r')
-        f = urllib2.urlopen(urllib2.Request(url))
+        try:
+            if timeout:
+                f = urllib2.urlopen(request, timeout=timeout)
+            else:
+                f = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304:
+                logging.info ('Listing not modified since last scrape: %s' % url)
+                return [], None
+            raise
 
         try:
             content = f.read()
+            headers = f.info()
         finally:
             f.close()        
         
@@ -167,80 +617,168 @@ class ESARollingArchive:
 
                records.append (record)
 
-        return records        
+        cache_entry = {
+            'etag': headers.getheader('ETag'),
+            'last_modified': headers.getheader('Last-Modified'),
+            'names': [r['name'] for r in records]
+            }
+
+        if self.cache and not full:
+            seen = set(cached.get('names', []))
+            listed = len(records)
+            records = [r for r in records if r['name'] not in seen]
+            logging.info ('Found %s new of %s listed images at %s' % (len(records), listed, url))
+
+        return records, cache_entry
                    
+    # all the urls an image can be downloaded from, best mirror first
+    # besides the scraped url this includes the same path on every other mirror whose last listing 
+    # contained the image; if prefer_host is given that mirror is tried first
+    def mirror_urls (self, item, prefer_host = None):
+        p = urlparse(item['url'])
+        hosts = [p.hostname]
+        if self.cache:
+            for listing in self.cache.listed_by(item['name']):
+                host = urlparse(listing).hostname
+                if host not in hosts:
+                    hosts.append (host)
+        hosts = self.health.rank(hosts, item.get('size_bytes'))
+        if prefer_host in hosts:
+            hosts.remove (prefer_host)
+            hosts.insert (0, prefer_host)
+        return [p._replace(netloc=p.netloc.replace(p.hostname, host)).geturl() for host in hosts]
+    
+    # download an image from the best available mirror, failing over to the others in turn
     # returns true if the download succeeds, else false
-    def download_image (self, url, dest_filename):
+    def download_product (self, item, dest_filename, limiter = None, prefer_host = None):
+        urls = self.mirror_urls(item, prefer_host)
+        for url in urls:
+            if self.download_image (url, dest_filename, item.get('size_bytes'), limiter):
+                return True
+            if url != urls[-1]:
+                logging.warning ('Failing over to next mirror for %s' % item['name'])
+        return False
+    
+    # returns true if the download succeeds, else false
+    # the file is streamed into dest_filename.part, which is resumed with a Range request after an 
+    # interruption, and only renamed to dest_filename once it is complete
+    # if size_bytes is given the downloaded file must be exactly that size
+    # limiter is an optional BandwidthLimiter shared with other transfers
+    def download_image (self, url, dest_filename, size_bytes = None, limiter = None):
     
         logging.info ('Downloading %s ...' % url)
         
-        # get temp file
-        tempdir = os.path.join(mkdtemp (),'')
-        tempfile = os.path.join(tempdir, os.path.basename(dest_filename) )
-        # use wget to donwload
-        cmd = 'wget -q %s --no-check-certificate --http-user=%s --http-password=%s --output-document=%s'
-
-        result = os.system (cmd % (url, self.user, self.password, tempfile))
-        # copy from temp file to dest file
-
-        shutil.copy(tempfile,dest_filename)
+        part_file = '%s.part' % dest_filename
+        retries = getattr(settings, 'DOWNLOAD_RETRIES', 3)
+        timeout = getattr(settings, 'DOWNLOAD_TIMEOUT', 60)
         
-        os.unlink(tempfile)
-        os.rmdir (tempdir)            
-
-#        retry = 5
-#        
-#        while retry > 0:
-#            try:
-#                r = urllib2.urlopen(urllib2.Request(url))
-#            except urllib2.HTTPError as err:
-#                logging.error ('Failed downloading url %s with error %s ' % (url, err))
-#                return False
-#            except urllib2.URLError as err:
-#                if err.reason[0] == 10060:
-#                    if retry > 1:
-#                        logging.warning ('Connection to %s timed out. Retrying...' % (url,))
-#                        retry -= 1
-#                    else:
-#                        logging.error ('Failed to connect to url %s with error %s ' % (url, err))
-#                        return False
-#                else:    
-#                    logging.error ('Failed to connect to url %s with error %s ' % (url, err))
-#                    return False
-#                
-#              
-#        try:
-#            with open(dest_filename, 'wb') as f:
-#                shutil.copyfileobj(r,f)
-#        finally:
-#            r.close()    
-                
+        attempt = 0
+        while True:
+            try:
+                self._fetch (url, part_file, size_bytes, timeout, limiter)
+                break
+            except (urllib2.URLError, httplib.HTTPException, socket.error, IOError), e:
+                self.health.record_failure (urlparse(url).hostname)
+                attempt += 1
+                if attempt > retries or (isinstance(e, urllib2.HTTPError) and e.code in (401, 403, 404)):
+                    # leave the partial file in place so a later run can resume it
+                    logging.error ('Failed downloading url %s with error %s ' % (url, e))
+                    return False
+                logging.warning ('Download of %s interrupted (%s). Retrying...' % (url, e))
+                time.sleep (min(60, 2 ** attempt))
+        
+        received = os.path.getsize(part_file)
+        if size_bytes and received != size_bytes:
+            logging.error ('Downloaded %s bytes from %s but expected %s' % (received, url, size_bytes))
+            os.unlink (part_file)
+            return False
+            
+        replace_file (part_file, dest_filename)
         return True       
+    
+    # download url into part_file, appending to whatever is already there
+    # raises IOError if the transfer ends before size_bytes have been received
+    def _fetch (self, url, part_file, size_bytes, timeout, limiter):
+        offset = 0
+        if os.path.exists(part_file):
+            offset = os.path.getsize(part_file)
+            if size_bytes and offset > size_bytes:
+                logging.warning ('Discarding oversized partial download: %s' % part_file)
+                os.unlink (part_file)
+                offset = 0
+            elif size_bytes and offset == size_bytes:
+                return
+        
+        request = urllib2.Request(url)
+        if offset:
+            logging.info ('Resuming download at byte %s' % offset)
+            request.add_header ('Range', 'bytes=%d-' % offset)
+        
+        start = time.time()
+        try:
+            r = urllib2.urlopen(request, timeout=timeout)
+        except urllib2.HTTPError, e:
+            # nothing left to send - the partial file is already complete
+            if e.code == 416 and offset:
+                return
+            raise
+        
+        try:
+            if offset and r.getcode() != 206:
+                logging.warning ('%s does not support resuming, restarting download' % url)
+                offset = 0
+            f = open(part_file, offset and 'ab' or 'wb')
+            latency = time.time() - start
+            received = 0
+            try:
+                while True:
+                    chunk = r.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    if limiter:
+                        limiter.consume (len(chunk))
+                    f.write (chunk)
+                    received += len(chunk)
+            finally:
+                f.close()
+        finally:
+            r.close()
+        
+        if received:
+            self.health.record_success (urlparse(url).hostname, received, time.time() - start - latency, latency)
+        
+        if size_bytes and os.path.getsize(part_file) < size_bytes:
+            raise IOError ('Connection closed after %s of %s bytes' % (os.path.getsize(part_file), size_bytes))
         
 
 class EnvisatBest:
     tempdir = None
     
-    def __init__(self, auto_cleanup = True):
-        self.tempdir = os.path.join(mkdtemp (),'')
+    # a child gets its own temp dir inside its parent's, so BEST runs with the same fixed 
+    # output names can go on at the same time
+    def __init__(self, auto_cleanup = True, parent = None):
+        if parent:
+            self.tempdir = os.path.join(mkdtemp (dir=parent.tempdir),'')
+        else:
+            self.tempdir = os.path.join(mkdtemp (),'')
         self.auto_cleanup = auto_cleanup
         logging.debug ('Using temp dir: %s' %self.tempdir )
     
     def __del__(self):
-        # delete all files in the temp directory and then delete the directory
+        # delete the temp directory along with any child directories in it
         
         if self.auto_cleanup and self.tempdir:
             logging.info ("Cleaning up temp directory...")
             logging.debug ("  %s" % self.tempdir)
             try:
-                for the_file in os.listdir(self.tempdir):
-                    file_path = os.path.join(self.tempdir, the_file)
-                    if os.path.isfile(file_path):
-                        os.unlink(file_path)
-                os.rmdir (self.tempdir)            
+                if os.path.exists (self.tempdir):
+                    shutil.rmtree (self.tempdir)
             except Exception, e:
                 logging.error ("%s" % e)
         self.tempdir=None
+    
+    def child (self):
+        return EnvisatBest(self.auto_cleanup, parent=self)
            
     #returns full path to ini file    
     def create_ini_file (self,content):
@@ -268,46 +806,367 @@ class Error (Exception):
 # supply patterns as regex patterns in a dictionary
 # returns results in a dictionary using the same keys as supplied with the patterns
 # finds the first match for each pattern
+#
+# each distinct set of patterns is compiled once per process, together with a combined 
+# alternation of all of them; a line only gets tested against the individual patterns if the 
+# combined one matches, and the scan stops as soon as every pattern has been found
 class FilePatternMatcher:
+    compiled = {}
+    
     def __init__(self, filename, patterns):
         self.filename = filename
         self.patterns = patterns
+        self.regexes, self.combined = self._compile(patterns)
+    
+    @classmethod
+    def _compile (cls, patterns):
+        key = tuple(sorted(patterns.items()))
+        if key not in cls.compiled:
+            regexes = dict([(k, re.compile(v)) for k, v in patterns.items()])
+            combined = re.compile('|'.join(['(?:%s)' % v for v in patterns.values()]))
+            cls.compiled[key] = (regexes, combined)
+        return cls.compiled[key]
         
     # if require_all is true, throws an exception if the end of the file is reached and not all 
     # patterns are matched
     def get_matches (self, require_all = True):
         matches = {}
+        pending = dict(self.regexes)
         
         f = open(self.filename, "r")
-        regexes = {}
-        for k,v in self.patterns.items():
-            regexes[k] = re.compile(v)
+        try:
+            for line in f:
+                if not self.combined.search (line):
+                    continue
+                for k in pending.keys():
+                    m = pending[k].findall (line)
+                    if m:
+                        del pending[k]
+                        matches[k] = m[0]
+                if not pending:
+                    break
+        finally:
+            f.close()
             
-        for line in f:
-            for k in regexes.keys():
-                m = regexes[k].findall (line)
-                if m:
-                    del regexes[k]
-                    matches[k] = m[0]
-        if regexes and require_all:
-            raise Error ('Failed to match all patterns while searching file: %s.\n%s' % (self.filename, regexes.keys()))
+        if pending and require_all:
+            raise Error ('Failed to match all patterns while searching file: %s.\n%s' % (self.filename, pending.keys()))
             
         return matches
             
 
+# reads the headers of an Envisat N1 product straight from the file
+# the MPH and SPH are ASCII KEY=value records at the start of the file; the SPH ends with the 
+# data set descriptors (DSDs) that give the offset and record size of each data set, which
+# is how the geolocation grid ADS is found
+class N1Header:
+    MPH_SIZE = 1247
+    GEOLOCATION_GRID = 'GEOLOCATION GRID ADS'
+    
+    # offsets of the tie point latitudes and longitudes (11 big-endian int32 each, in 
+    # 10^-6 degrees) for the first and last line of an ASAR geolocation grid ADSR
+    grid_offsets = {'first': (157, 201), 'last': (411, 455)}
+    
+    def __init__ (self, filename):
+        self.filename = filename
+        self.mph = {}
+        self.sph = {}
+        self.dsds = {}
+        self.grid = None
+        
+        f = open(filename, 'rb')
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self._read (mm)
+            finally:
+                mm.close()
+        finally:
+            f.close()
+    
+    def _read (self, mm):
+        self.mph = self._parse_records(mm[:self.MPH_SIZE])
+        if not self.mph.get('PRODUCT'):
+            raise Error ('Not an Envisat N1 product: %s' % self.filename)
+        
+        sph_size = int(self.mph['SPH_SIZE'])
+        dsd = None
+        for key, value in self._records(mm[self.MPH_SIZE:self.MPH_SIZE + sph_size]):
+            if key == 'DS_NAME':
+                dsd = {}
+                self.dsds[value] = dsd
+            if dsd is None:
+                self.sph[key] = value
+            else:
+                dsd[key] = value
+        
+        # keep just the first and last records of the geolocation grid
+        grid = self.dsds.get(self.GEOLOCATION_GRID)
+        if grid and int(grid.get('NUM_DSR', 0)) > 0:
+            offset = int(grid['DS_OFFSET'])
+            size = int(grid['DSR_SIZE'])
+            last = offset + (int(grid['NUM_DSR']) - 1) * size
+            self.grid = {'first': mm[offset:offset + size], 'last': mm[last:last + size]}
+    
+    # yields (key, value) for each KEY=value line, with quotes and <units> removed
+    def _records (self, data):
+        for line in data.split('\n'):
+            if '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            value = re.sub('<[^>]*>$', '', value.strip())
+            yield key.strip(), value.strip('"').strip()
+    
+    def _parse_records (self, data):
+        return dict(self._records(data))
+    
+    # tie point (lat, lng) in 10^-6 degrees from the first or last line of the grid
+    # sample is 0 for the first (near range) sample and -1 for the last
+    def _grid_point (self, line, sample):
+        record = self.grid[line]
+        lat_offset, lng_offset = self.grid_offsets[line]
+        lats = struct.unpack('>11i', record[lat_offset:lat_offset + 44])
+        lngs = struct.unpack('>11i', record[lng_offset:lng_offset + 44])
+        return lats[sample], lngs[sample]
+    
+    # the same fields extract_footprint reads from the BEST header dump: the pass designator 
+    # and the lat/lng of each corner in 10^-6 degrees
+    # ff = first sample first line, lf = last sample first line
+    # fl = first sample last line, ll = last sample last line
+    def footprint_fields (self):
+        fields = {'pass': self.sph['PASS']}
+        sph_keys = {'ff': 'FIRST_NEAR', 'lf': 'FIRST_FAR', 'fl': 'LAST_NEAR', 'll': 'LAST_FAR'}
+        if all(['%s_LAT' % k in self.sph for k in sph_keys.values()]):
+            for corner, k in sph_keys.items():
+                fields['%s_lat' % corner] = int(self.sph['%s_LAT' % k])
+                fields['%s_lng' % corner] = int(self.sph['%s_LONG' % k])
+        elif self.grid:
+            grid_keys = {'ff': ('first', 0), 'lf': ('first', -1), 'fl': ('last', 0), 'll': ('last', -1)}
+            for corner, (line, sample) in grid_keys.items():
+                fields['%s_lat' % corner], fields['%s_lng' % corner] = self._grid_point(line, sample)
+        else:
+            raise Error ('No corner coordinates in N1 header: %s' % self.filename)
+        return fields
+    
+
+# reads the georeferencing tags of a (Big)TIFF file without GDAL
+class GeoTiff:
+    # tiff field types: struct format and size
+    field_types = {1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 
+        7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8), 11: ('f', 4), 12: ('d', 8), 
+        16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+    
+    IMAGE_WIDTH = 256
+    IMAGE_LENGTH = 257
+    MODEL_PIXEL_SCALE = 33550
+    MODEL_TIEPOINT = 33922
+    MODEL_TRANSFORMATION = 34264
+    GEO_KEY_DIRECTORY = 34735
+    GT_RASTER_TYPE = 1025
+    RASTER_PIXEL_IS_POINT = 2
+    
+    def __init__ (self, filename):
+        self.filename = filename
+        self.tags = {}
+        f = open(filename, 'rb')
+        try:
+            self._read_ifd (f)
+        finally:
+            f.close()
+    
+    # read the tags of the first image file directory
+    def _read_ifd (self, f):
+        header = f.read(16)
+        if header[:2] == 'II':
+            e = '<'
+        elif header[:2] == 'MM':
+            e = '>'
+        else:
+            raise IOError ('Not a tiff file: %s' % self.filename)
+            
+        magic = struct.unpack(e + 'H', header[2:4])[0]
+        if magic == 42:
+            ifd_offset = struct.unpack(e + 'I', header[4:8])[0]
+            count_fmt, entry_fmt, entry_size, inline_size = 'H', 'HHI', 12, 4
+        elif magic == 43:
+            ifd_offset = struct.unpack(e + 'Q', header[8:16])[0]
+            count_fmt, entry_fmt, entry_size, inline_size = 'Q', 'HHQ', 20, 8
+        else:
+            raise IOError ('Not a tiff file: %s' % self.filename)
+        
+        f.seek (ifd_offset)
+        count_size = struct.calcsize(count_fmt)
+        count = struct.unpack(e + count_fmt, f.read(count_size))[0]
+        entries = f.read(count * entry_size)
+        
+        for i in range(count):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type, n = struct.unpack(e + entry_fmt, entry[:entry_size - inline_size])
+            if field_type not in self.field_types:
+                continue
+            fmt, size = self.field_types[field_type]
+            data = entry[entry_size - inline_size:]
+            if n * size > inline_size:
+                offset = struct.unpack(e + (inline_size == 4 and 'I' or 'Q'), data)[0]
+                f.seek (offset)
+                data = f.read(n * size)
+            self.tags[tag] = struct.unpack(e + fmt * n, data[:n * size])
+    
+    # the GDAL style affine geotransform of the image
+    def geotransform (self):
+        if self.MODEL_TRANSFORMATION in self.tags:
+            m = self.tags[self.MODEL_TRANSFORMATION]
+            gt = [m[3], m[0], m[1], m[7], m[4], m[5]]
+        elif self.MODEL_TIEPOINT in self.tags and self.MODEL_PIXEL_SCALE in self.tags:
+            i, j, k, x, y, z = self.tags[self.MODEL_TIEPOINT][:6]
+            sx, sy = self.tags[self.MODEL_PIXEL_SCALE][:2]
+            gt = [x - i * sx, sx, 0.0, y + j * sy, 0.0, -sy]
+        else:
+            raise IOError ('No georeferencing in tiff file: %s' % self.filename)
+        
+        # like GDAL, shift point-registered rasters so the transform refers to pixel corners
+        keys = self.tags.get(self.GEO_KEY_DIRECTORY, ())
+        for n in range(4, len(keys) - 3, 4):
+            if keys[n] == self.GT_RASTER_TYPE and keys[n + 1] == 0 and keys[n + 3] == self.RASTER_PIXEL_IS_POINT:
+                gt[0] -= 0.5 * gt[1] + 0.5 * gt[2]
+                gt[3] -= 0.5 * gt[4] + 0.5 * gt[5]
+        return gt
+    
+    # (west, south, east, north) of the image extent
+    def bounds (self):
+        gt = self.geotransform ()
+        width = self.tags[self.IMAGE_WIDTH][0]
+        height = self.tags[self.IMAGE_LENGTH][0]
+        xs = []
+        ys = []
+        for px, py in ((0, 0), (width, 0), (0, height), (width, height)):
+            xs.append (gt[0] + px * gt[1] + py * gt[2])
+            ys.append (gt[3] + px * gt[4] + py * gt[5])
+        return min(xs), min(ys), max(xs), max(ys)
+    
+
+# content-addressed store of BEST stage outputs, so re-processing an image with the same 
+# inputs and parameters restores each stage's files instead of running BEST again
+# every entry is a directory named by its key; entries are used least recently first when 
+# the cache grows beyond max_bytes
+class ArtifactCache:
+    def __init__ (self, cache_dir, max_bytes = 0, stages = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stages = stages
+        self.lock = threading.Lock()
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+    
+    def caches (self, stage):
+        return self.stages is None or stage in self.stages
+    
+    def key (self, *parts):
+        return hashlib.sha1('\0'.join([str(p) for p in parts])).hexdigest()
+    
+    def _entry (self, key):
+        return os.path.join(self.cache_dir, key)
+    
+    # copy the files of a cached entry into dest_dir, returning False if there is no entry
+    def restore (self, key, dest_dir):
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        try:
+            for f in os.listdir(entry):
+                shutil.copy2 (os.path.join(entry, f), os.path.join(dest_dir, f))
+            os.utime (entry, None)
+        except (IOError, OSError), e:
+            logging.warning ('Failed to restore cache entry %s: %s' % (key, e))
+            return False
+        return True
+    
+    # copy files into a new entry
+    # the entry is assembled in a temp dir and renamed into place, so a reader never sees a 
+    # partial entry; if another worker stored the same key first its entry is kept, unless 
+    # replace is set
+    def store (self, key, files, replace = False):
+        entry = self._entry(key)
+        if os.path.isdir(entry) and not replace:
+            return
+        tempdir = mkdtemp (dir=self.cache_dir, prefix='.tmp-')
+        try:
+            for f in files:
+                shutil.copy2 (f, os.path.join(tempdir, os.path.basename(f)))
+            if replace and os.path.isdir(entry):
+                # moved aside first, as a directory can't be renamed over a non-empty one
+                old = mkdtemp (dir=self.cache_dir, prefix='.tmp-')
+                os.rename (entry, os.path.join(old, key))
+                shutil.rmtree (old, ignore_errors=True)
+            os.rename (tempdir, entry)
+        except (IOError, OSError), e:
+            if not os.path.isdir(entry):
+                logging.warning ('Failed to store cache entry %s: %s' % (key, e))
+            shutil.rmtree (tempdir, ignore_errors=True)
+            return
+        self.evict ()
+    
+    # remove the least recently used entries until the cache fits in max_bytes
+    def evict (self):
+        if not self.max_bytes:
+            return
+        with self.lock:
+            entries = []
+            total = 0
+            for key in os.listdir(self.cache_dir):
+                entry = self._entry(key)
+                if key.startswith('.') or not os.path.isdir(entry):
+                    continue
+                try:
+                    size = sum([os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)])
+                    entries.append ((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    continue
+                total += size
+            entries.sort ()
+            for mtime, size, entry in entries:
+                if total <= self.max_bytes:
+                    break
+                logging.debug ('Evicting cache entry %s' % entry)
+                shutil.rmtree (entry, ignore_errors=True)
+                total -= size
+    
+
+# the corners of an image as a polygon ring of lat/lng dicts, from the pass and the 
+# microdegree first/last sample and line coordinates in the image header
+def footprint_corners (fields):
+    if fields['pass'] == 'ASCENDING':
+        coord_map = {'ff':0, 'lf': 1, 'fl': 3, 'll': 2}
+    else:
+        coord_map = {'ff':2, 'lf': 3, 'fl': 1, 'll': 0}
+    
+    corners = [{}, {}, {}, {}]
+    for k,v in coord_map.items():
+        corners[v]['lat'] = float(fields['%s_lat'%k])/1000000
+        corners[v]['lng'] = float(fields['%s_lng'%k])/1000000
+    return corners
+
+
 class AsarImageFile:
     processor = None
     ini_templates = None
     n1_file = None
     header_txt_file = None
+    geotiff_file = None
     default_params = None
     sensor_modes = {'IMM': 'Image', 'WSM': 'Wide Swath', 'APM':'Alternating Polarization'}
     
-    def __init__ (self, processor, n1_file):
+    def __init__ (self, processor, n1_file, cache = None):
         self.processor = processor    
         self.n1_file = n1_file
+        self.cache = cache
+        self.stage_keys = {}
         self.ini_templates = self.get_ini_templates()
-        self.params = {'n1_file': self.n1_file, 'output_dir': self.processor.tempdir, 'input_dir': self.processor.tempdir}    
+        self.params = {'n1_file': self.n1_file, 'output_dir': self.processor.tempdir, 'input_dir': self.processor.tempdir, 
+            'header_dir': self.processor.tempdir}    
         sensor_key = os.path.basename(n1_file)[4:7]
         
         if sensor_key in self.sensor_modes:
@@ -321,23 +1180,102 @@ class AsarImageFile:
         logging.info ('Extracting header data...')
         logging.debug ('   from %s' % self.n1_file )
         
-        self.processor.execute (self.ini_templates['header'].substitute(self.params))
-
-        file = os.path.join(self.params['output_dir'], 'header.txt')
-        
-        if not os.path.exists (file):
-            raise Error ('Failed to extract header')
+        file = self._run_stage ('header', self.ini_templates['header'].substitute(self.params), 
+            'header.txt', 'Failed to extract header')
             
         self.header_txt_file = file    
 
-    def extract_footprint (self):
+    # run one BEST stage and return the path of its main output file, raising error if it was 
+    # not produced
+    # with an artifact cache the stage is keyed by the N1 file, the stage, the ini file (with 
+    # the working paths taken out) and the key of the stage it depends on, and a cached result 
+    # is restored into the output dir instead of running BEST
+    def _run_stage (self, stage, ini, output, error, depends = None):
+        out_dir = self.params['output_dir']
+        path = os.path.join(out_dir, output)
+        
+        # every stage is keyed, cached or not, so a stage's key always covers the stages 
+        # upstream of it
+        key = None
+        restored = False
+        if self.cache:
+            digest = ini.replace(self.n1_file, '$n1_file')
+            # longest first, as a branch's work dir is inside its parent's
+            dirs = set([self.params[k] for k in ('header_dir', 'output_dir', 'input_dir')])
+            for dir in sorted(dirs, key=len, reverse=True):
+                digest = digest.replace(dir, '$work_dir')
+            key = self.cache.key(self._identity(), stage, digest, self.stage_keys.get(depends) or '')
+            self.stage_keys[stage] = key
+            if self.cache.caches(stage):
+                restored = self.cache.restore (key, out_dir)
+                if restored and os.path.exists (path):
+                    logging.info ('Restored %s stage from artifact cache' % stage)
+                    return path
+        
+        before = self._snapshot (out_dir)
+        self.processor.execute (ini)
+        if not os.path.exists (path):
+            raise Error (error)
+        
+        if key and self.cache.caches(stage):
+            after = self._snapshot (out_dir)
+            files = [f for f in after if after[f] != before.get(f) and f not in ('parameters.ini', 'best.out')]
+            # an entry that was restored without the output file is broken, and replaced
+            self.cache.store (key, [os.path.join(out_dir, f) for f in files], replace=restored)
+        return path
+    
+    # name and size of the N1 file
+    def _identity (self):
+        name = os.path.basename(self.n1_file)
+        if os.path.exists (self.n1_file):
+            return '%s:%s' % (name, os.path.getsize(self.n1_file))
+        return name
+    
+    def _snapshot (self, dir):
+        files = {}
+        for f in os.listdir(dir):
+            path = os.path.join(dir, f)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                files[f] = (stat.st_size, stat.st_mtime)
+        return files
+    
+    # a copy of this image with its own work dir, sharing the header analysis (which is 
+    # extracted first if need be), for running a fullres chain alongside others
+    def branch (self):
+        self._require_header ()
+        image = AsarImageFile(self.processor.child(), self.n1_file, self.cache)
+        image.header_txt_file = self.header_txt_file
+        image.params['header_dir'] = self.params['output_dir']
+        image.stage_keys = self.stage_keys.copy()
+        return image
+    
+    # BEST's header analysis, which the quicklook and fullres stages read, is only extracted 
+    # the first time one of them needs it
+    def _require_header (self):
         if not self.header_txt_file:
-            raise Error ('You must call extract_header() before calling extract_footprint()')
+            self.extract_header ()
+    
+    # reads the pass and corners straight from the N1 headers, falling back to the BEST header 
+    # dump if the file can't be parsed
+    def extract_footprint (self):
+        logging.info ('Extracting footprint...')
+        try:
+            matches = N1Header(self.n1_file).footprint_fields ()
+        except (Error, IOError, ValueError, KeyError, struct.error), e:
+            logging.warning ('Unable to read N1 header directly (%s), using BEST header analysis' % e)
+            matches = self._extract_header_footprint ()
+            
+        matches['corners'] = footprint_corners (matches)
+        
+        return matches
+    
+    def _extract_header_footprint (self):
+        self._require_header ()
 
         if not os.path.exists (self.header_txt_file):
             raise Error ('Header text file does not exist at: %s' %self.header_txt_file)
         
-        logging.info ('Extracting footprint...')
         logging.debug ('  from header file: %s' % self.header_txt_file)
         
         # ff = first sample first line
@@ -357,59 +1295,21 @@ class AsarImageFile:
         }        
         
         matcher = FilePatternMatcher (self.header_txt_file, patterns)        
-        matches = matcher.get_matches ()
-        if matches['pass'] == 'ASCENDING':
-            coord_map = {'ff':0, 'lf': 1, 'fl': 3, 'll': 2}
-        else:
-            coord_map = {'ff':2, 'lf': 3, 'fl': 1, 'll': 0}
-        
-        corners = [{}, {}, {}, {}]
-        for k,v in coord_map.items():
-            corners[v]['lat'] = float(matches['%s_lat'%k])/1000000
-            corners[v]['lng'] = float(matches['%s_lng'%k])/1000000
-        
-        matches['corners'] = corners
+        return matcher.get_matches ()
         
-        return matches
-        
-    def extract_geotiff_footprint (self):
+    # corners of the georeferenced extent of a geotiff, by default the last one extracted
+    def extract_geotiff_footprint (self, geotiff_file = None):
     
-        txt_file = os.path.join(self.params['output_dir'], 'gdalinfo.txt')
-
-        if not os.path.exists (txt_file):
-            raise Error ('gdalinfo text file does not exist at: %s' % txt_file)
+        geotiff_file = geotiff_file or self.geotiff_file
+        if not geotiff_file or not os.path.exists (geotiff_file):
+            raise Error ('Geotiff does not exist at: %s' % geotiff_file)
         
-        logging.debug ('Extracting geotiff footprint from: %s' % txt_file)
+        logging.debug ('Extracting geotiff footprint from: %s' % geotiff_file)
 
-        patterns = {
-            'bottom_left_lat':  'Lower Left[\s]*\([\s]*[+\-\d\.]+[\s]*,[\s]*([+\-\d\.]+)[\s]*\)',
-            'bottom_right_lat': 'Lower Right[\s]*\([\s]*[+\-\d\.]+[\s]*,[\s]*([+\-\d\.]+)[\s]*\)',
-            'top_left_lat':     'Upper Left[\s]*\([\s]*[+\-\d\.]+[\s]*,[\s]*([+\-\d\.]+)[\s]*\)',
-            'top_right_lat':    'Upper Right[\s]*\([\s]*[+\-\d\.]+[\s]*,[\s]*([+\-\d\.]+)[\s]*\)',
-            'bottom_left_lon':  'Lower Left[\s]*\([\s]*([+\-\d\.]+)[\s]*,[\s]*[+\-\d\.]+[\s]*\)',
-            'bottom_right_lon': 'Lower Right[\s]*\([\s]*([+\-\d\.]+)[\s]*,[\s]*[+\-\d\.]+[\s]*\)',
-            'top_left_lon':     'Upper Left[\s]*\([\s]*([+\-\d\.]+)[\s]*,[\s]*[+\-\d\.]+[\s]*\)',
-            'top_right_lon':    'Upper Right[\s]*\([\s]*([+\-\d\.]+)[\s]*,[\s]*[+\-\d\.]+[\s]*\)'
-        }        
-
-#        patterns = {
-#            'bottom_left_lat': 'bottom_left_lat =(.*)',
-#            'bottom_left_lon': 'bottom_left_lon =(.*)',
-#            'bottom_right_lat': 'bottom_right_lat =(.*)',
-#            'bottom_right_lon': 'bottom_right_lon =(.*)',
-#            'top_left_lat': 'top_left_lat =(.*)',
-#            'top_left_lon': 'top_left_lon =(.*)',
-#            'top_right_lat': 'top_right_lat =(.*)',
-#            'top_right_lon': 'top_right_lon =(.*)'
-#        }        
-        
-        matcher = FilePatternMatcher (txt_file, patterns)        
-        matches = matcher.get_matches ()
-
-        north = max (matches['top_left_lat'], matches['top_right_lat'])    
-        south = min (matches['bottom_left_lat'], matches['bottom_right_lat'])    
-        east = max (matches['bottom_right_lon'], matches['top_right_lon'])    
-        west = min (matches['bottom_left_lon'], matches['top_left_lon'])    
+        try:
+            west, south, east, north = GeoTiff(geotiff_file).bounds ()
+        except (IOError, struct.error), e:
+            raise Error ('Failed to read geotiff extent from %s: %s' % (geotiff_file, e))
 
         corners = [
             {'lat':south, 'lng':west}, 
@@ -419,21 +1319,10 @@ class AsarImageFile:
             ]
         return corners
         
-#        patterns = [
-#            {'pattern': 'bottom_left_lat =', 'corner': 0, 'coord': 'lat'}, 
-#            {'pattern': 'bottom_left_lon =', 'corner': 0, 'coord': 'lng'}, 
-#            {'pattern': 'bottom_right_lat =',  'corner': 1, 'coord': 'lat'}, 
-#            {'pattern': 'bottom_right_lon =', 'corner': 1, 'coord': 'lng'}, 
-#            {'pattern': 'top_left_lat =', 'corner': 3, 'coord': 'lat'}, 
-#            {'pattern': 'top_left_lon =', 'corner': 3, 'coord': 'lng'}, 
-#            {'pattern': 'top_right_lat =',  'corner': 2, 'coord': 'lat'}, 
-#            {'pattern': 'top_right_lon =', 'corner': 2, 'coord': 'lng'} 
-#            ]
-        
-    
     def extract_fullres (self, bbox = None):
     
         logging.debug ('Extracting full res data from: %s' % self.n1_file )
+        self._require_header ()
         params = self.params.copy()
         if bbox:
             logging.debug ('Using bounding box: %s' % bbox)
@@ -442,54 +1331,54 @@ class AsarImageFile:
         else:
             ini_template = 'fullres'
     
-        self.processor.execute (self.ini_templates[ini_template].substitute(params))
-        
-        if not os.path.exists (os.path.join(self.params['output_dir'], 'fullres.XTs')):
-            raise Error ('BEST Failed to extract full res')
+        self._run_stage ('fullres', self.ini_templates[ini_template].substitute(params), 
+            'fullres.XTs', 'BEST Failed to extract full res', depends='header')
 
 
     def geocorrect (self):
         logging.debug ('geocorrecting from extracted full res image')
-        self.processor.execute (self.ini_templates['geocorrect'].substitute(self.params))
-        if not os.path.exists (os.path.join(self.params['output_dir'], 'geocorrect.GRf')):
-            raise Error ('BEST Failed to geocorrect image')
+        self._run_stage ('geocorrect', self.ini_templates['geocorrect'].substitute(self.params), 
+            'geocorrect.GRf', 'BEST Failed to geocorrect image', depends='fullres')
 
     def adjust_gain (self):
         logging.debug ('Adjusting gain from geocorrected image')
-        self.processor.execute (self.ini_templates['adjust_gain'].substitute(self.params))
-        if not os.path.exists (os.path.join(self.params['output_dir'], 'gain.GCi')):
-            raise Error ('BEST Failed to produce gain adjusted image')
+        self._run_stage ('adjust_gain', self.ini_templates['adjust_gain'].substitute(self.params), 
+            'gain.GCi', 'BEST Failed to produce gain adjusted image', depends='geocorrect')
         
-    def extract_geotiff (self, dest_file):
+    def extract_geotiff (self, dest_file, bbox = None):
         logging.info ('Extracting geotiff to: %s' % dest_file)
+        self.warp_geotiff (self.export_geotiff (), dest_file, bbox)
+
+    # export the gain adjusted image as a geotiff in BEST's projection
+    def export_geotiff (self):
         params = self.params.copy()
         
-        abs_file = os.path.abspath(dest_file)
-        
         #params['output_dir'] = os.path.join (os.path.dirname(abs_file), '')
         #params['output_file'] = os.path.basename(abs_file)
         
-        self.processor.execute (self.ini_templates['geotiff'].substitute(params))
+        return self._run_stage ('geotiff', self.ini_templates['geotiff'].substitute(params), 
+            'geotiff.tif', 'BEST Failed to export geotiff', depends='adjust_gain')
+    
+    # re-project an exported geotiff to lat/lng, cut to bbox if one is given, so several 
+    # AOIs can be cut from one export
+    def warp_geotiff (self, geotiff, dest_file, bbox = None):
+        logging.debug ('Warping %s to: %s' % (geotiff, dest_file))
         
-        geotiff = os.path.join(params['output_dir'], 'geotiff.tif')
-        if not os.path.exists (geotiff):
-            raise Error ('BEST Failed to export geotiff')
+        extent = ''
+        if bbox:
+            extent = '-te %(bbox_lng1)s %(bbox_lat2)s %(bbox_lng2)s %(bbox_lat1)s ' % bbox
         
         if os.path.exists (dest_file):
             os.unlink (dest_file)
-        os.system ('gdalwarp -t_srs EPSG:4326 -r cubic -co COMPRESS=LZW %s %s' % (geotiff, dest_file))
+        os.system ('gdalwarp -t_srs EPSG:4326 %s-r cubic -co COMPRESS=LZW %s %s' % (extent, geotiff, dest_file))
         if not os.path.exists (dest_file):
             raise Error ('GDAL Warp failed to re-project geotiff')
-            
-        gdalinfo_file = os.path.join(params['output_dir'], 'gdalinfo.txt')
-        os.system ('gdalinfo %s > %s' % (dest_file, gdalinfo_file))
-        if not os.path.exists (gdalinfo_file):
-            raise Error ('GDALINFO failed to extract geotiff metadata')
+        
+        self.geotiff_file = dest_file
 
     def extract_quicklook (self, dest_file):
     
-        if not self.header_txt_file:
-            raise Error ('You must call extract_header() before calling extract_quicklook()')
+        self._require_header ()
 
         if not os.path.exists (self.header_txt_file):
             raise Error ('Header text file does not exist at: %s' %self.header_txt_file)
@@ -502,12 +1391,8 @@ class AsarImageFile:
         
 #        params['output_dir'] = os.path.join (os.path.dirname(abs_file), '')
 #        params['output_file'] = os.path.basename(abs_file)
-        self.processor.execute (self.ini_templates['quicklook'].substitute(self.params))
-        
-        ql_file = os.path.join(self.processor.tempdir, 'ql.tif')
-        
-        if not os.path.exists(ql_file):
-            raise Error ('Error: BEST failed to extract quicklook image')
+        ql_file = self._run_stage ('quicklook', self.ini_templates['quicklook'].substitute(self.params), 
+            'ql.tif', 'Error: BEST failed to extract quicklook image', depends='header')
 
         shutil.copy(ql_file,abs_file)
     
@@ -536,7 +1421,7 @@ Acknowledge Mount = 'N'
 [FULL RESOLUTION]
 Input Media Path = "$n1_file"
 Input Media Type = "disk"
-Input Dir = "$input_dir"
+Input Dir = "$header_dir"
 Output Dir = "$output_dir"
 Header Analysis File = "header.HAN"
 Output Image = "fullres"
@@ -553,7 +1438,7 @@ Acknowledge Mount = 'N'
 [FULL RESOLUTION]
 Input Media Path = "$n1_file"
 Input Media Type = "disk"
-Input Dir = "$input_dir"
+Input Dir = "$header_dir"
 Output Dir = "$output_dir"
 Header Analysis File = "header.HAN"
 Output Image = "fullres"
@@ -592,7 +1477,7 @@ Output Image = "geotiff"
 [QUICK LOOK]
 Input Media Path = "$n1_file"
 Input Media Type = "disk"
-Input Dir = "$input_dir"
+Input Dir = "$header_dir"
 Output Dir = "$output_dir"
 Header Analysis File = "header.HAN"
 Output Quick Look Image= "ql"
@@ -608,108 +1493,1220 @@ Acknowledge Mount = 'N'
 
         return templates
 	
-class S3Loader:
-    s3 = None
+# keep-alive connections to one host, shared between upload threads
+class ConnectionPool:
+    def __init__ (self, host, https = False, timeout = None, size = 8):
+        self.host = host
+        self.https = https
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue(size)
+    
+    def get (self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            if self.https:
+                return httplib.HTTPSConnection(self.host, timeout=self.timeout)
+            return httplib.HTTPConnection(self.host, timeout=self.timeout)
+    
+    # return a connection for reuse, or close it if it's broken or the pool is full
+    def put (self, conn, reusable = True):
+        if reusable:
+            try:
+                self.idle.put_nowait (conn)
+                return
+            except Queue.Full:
+                pass
+        conn.close ()
+
+
+# uploads files to S3 with signed REST requests over pooled connections
+# files larger than the multipart chunk size are split into parts that are uploaded at the 
+# same time, and put_files uploads several files at once
+# the endpoint and keys come from the s3cmd config, so host_base can point at any 
+# S3-compatible server; a host_bucket without %(bucket)s gives path-style urls
+class S3Uploader:
+    def __init__ (self, config, part_workers = 4, file_workers = 4):
+        self.access_key = config.access_key
+        self.secret_key = config.secret_key
+        self.host_base = config.host_base
+        self.host_bucket = getattr(config, 'host_bucket', '%(bucket)s.' + config.host_base)
+        self.chunk_size = max(5, int(getattr(config, 'multipart_chunk_size_mb', 15))) * 1024 * 1024
+        self.retries = getattr(settings, 'S3_RETRIES', 3)
+        self.part_workers = part_workers
+        self.file_workers = file_workers
+        self.use_https = str(getattr(config, 'use_https', False)) in ('True', 'true', '1')
+        self.timeout = int(getattr(config, 'socket_timeout', 300))
+        self.pools = {}
+        self.lock = threading.Lock()
+    
+    def _pool (self, host):
+        with self.lock:
+            if host not in self.pools:
+                self.pools[host] = ConnectionPool(host, self.use_https, self.timeout, 
+                    max(self.part_workers, self.file_workers) * 2)
+            return self.pools[host]
+    
+    # host and request path for a key
+    def _location (self, bucket, key):
+        path = '/' + urllib.quote(key)
+        if '%(bucket)s' in self.host_bucket:
+            return self.host_bucket % {'bucket': bucket}, path
+        return self.host_bucket, '/' + bucket + path
+    
+    def _sign (self, method, bucket, key, subresource, headers):
+        amz = ''.join(['%s:%s\n' % (k.lower(), headers[k]) for k in sorted(headers, key=str.lower) if k.lower().startswith('x-amz-')])
+        resource = '/%s/%s' % (bucket, urllib.quote(key))
+        if subresource:
+            resource += '?' + subresource
+        string_to_sign = '%s\n%s\n%s\n%s\n%s%s' % (method, headers.get('Content-MD5', ''), 
+            headers.get('Content-Type', ''), headers['Date'], amz, resource)
+        signature = base64.b64encode(hmac.new(self.secret_key, string_to_sign, hashlib.sha1).digest())
+        return 'AWS %s:%s' % (self.access_key, signature)
+    
+    # send a request, retrying on connection errors and server errors
+    # returns the response and its body
+    def _request (self, method, bucket, key, subresource = '', body = '', headers = None):
+        host, path = self._location (bucket, key)
+        if subresource:
+            path += '?' + subresource
+        pool = self._pool (host)
+        
+        for attempt in range(self.retries + 1):
+            h = dict(headers or {})
+            h['Date'] = formatdate(usegmt=True)
+            h['Content-Length'] = str(len(body))
+            if body:
+                h['Content-MD5'] = base64.b64encode(hashlib.md5(body).digest())
+            h['Authorization'] = self._sign (method, bucket, key, subresource, h)
+            
+            conn = pool.get ()
+            try:
+                conn.request (method, path, body, h)
+                response = conn.getresponse ()
+                data = response.read ()
+            except (socket.error, httplib.HTTPException), e:
+                pool.put (conn, False)
+                error = str(e)
+            else:
+                pool.put (conn, not response.will_close)
+                if response.status < 300:
+                    return response, data
+                error = 'HTTP %s %s' % (response.status, data[:200])
+                if response.status < 500:
+                    break
+            logging.warning ('S3 %s %s failed (%s)' % (method, path, error))
+            if attempt < self.retries:
+                time.sleep (2 ** attempt)
+        raise Error ('S3 %s %s failed: %s' % (method, path, error))
     
+    def _parse_uri (self, s3_uri):
+        bucket, key = s3_uri[len('s3://'):].split('/', 1)
+        return bucket, key
+    
+    def put_file (self, filename, s3_uri):
+        bucket, key = self._parse_uri (s3_uri)
+        size = os.path.getsize(filename)
+        headers = {'Content-Type': mimetypes.guess_type(filename)[0] or 'binary/octet-stream'}
+        logging.debug ('Uploading %s to %s (%s bytes)' % (filename, s3_uri, size))
+        
+        if size <= self.chunk_size:
+            f = open(filename, 'rb')
+            try:
+                body = f.read()
+            finally:
+                f.close()
+            self._request ('PUT', bucket, key, body=body, headers=headers)
+        else:
+            self._put_multipart (filename, bucket, key, size, headers)
+    
+    def _put_multipart (self, filename, bucket, key, size, headers):
+        response, data = self._request ('POST', bucket, key, 'uploads', headers=headers)
+        match = re.search ('<UploadId>([^<]+)</UploadId>', data)
+        if not match:
+            raise Error ('S3 did not return an upload id for %s' % key)
+        upload_id = match.group(1)
+        
+        def put_part (number):
+            f = open(filename, 'rb')
+            try:
+                f.seek ((number - 1) * self.chunk_size)
+                body = f.read (self.chunk_size)
+            finally:
+                f.close()
+            response, data = self._request ('PUT', bucket, key, 
+                'partNumber=%s&uploadId=%s' % (number, urllib.quote(upload_id)), body=body)
+            return number, response.getheader('ETag')
+        
+        parts = range(1, -(-size // self.chunk_size) + 1)
+        pool = ThreadPool(min(self.part_workers, len(parts)))
+        try:
+            etags = pool.map (put_part, parts)
+            body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+                ['<Part><PartNumber>%s</PartNumber><ETag>%s</ETag></Part>' % p for p in etags])
+            self._request ('POST', bucket, key, 'uploadId=%s' % urllib.quote(upload_id), body=body)
+        except:
+            try:
+                self._request ('DELETE', bucket, key, 'uploadId=%s' % urllib.quote(upload_id))
+            except Error, e:
+                logging.warning ('Failed to abort upload of %s: %s' % (key, e))
+            raise
+        finally:
+            pool.close ()
+            pool.join ()
+    
+    # upload a list of (filename, s3_uri) pairs at the same time
+    def put_files (self, files):
+        if len(files) < 2:
+            for filename, s3_uri in files:
+                self.put_file (filename, s3_uri)
+            return
+        pool = ThreadPool(min(self.file_workers, len(files)))
+        try:
+            pool.map (lambda f: self.put_file (*f), files)
+        finally:
+            pool.close ()
+            pool.join ()
+
+
+class S3Loader:
     def __init__(self, config=settings.S3_CONFIG_FILE):
-        self.s3 = S3(Config(config))
+        self.config = Config(config)
+        self.uploader = S3Uploader(self.config, 
+            part_workers=getattr(settings, 'S3_PART_WORKERS', 4),
+            file_workers=getattr(settings, 'S3_FILE_WORKERS', 4))
         
     def put_file (self, filename, s3_uri):
-        self.s3.object_put (filename, S3Uri(s3_uri))
+        self.uploader.put_file (filename, s3_uri)
+        return self.website_url (s3_uri)
+    
+    # upload several files at once, returning their website urls
+    def put_files (self, files):
+        self.uploader.put_files (files)
+        return [self.website_url (s3_uri) for filename, s3_uri in files]
+    
+    def website_url (self, s3_uri):
         return s3_uri.replace('s3://satimage', 'http://satimage.s3-website-us-east-1.amazonaws.com')
                 
     
+# downloads queued images with a fixed number of concurrent transfers
+# no more than per_host transfers run against any one mirror at a time, and together the 
+# transfers never exceed max_rate bytes per second (0 for no limit)
+# each image's status is updated as soon as its own transfer finishes
+#
+# if on_downloaded is given, each downloaded image is moved straight to PROCESSING, keeping 
+# its lease, and passed to on_downloaded before its transfer slot is freed, so a blocking 
+# callback holds back further downloads
+class DownloadPool:
+    def __init__ (self, processor, workers, per_host, max_rate = 0, on_downloaded = None):
+        self.processor = processor
+        self.on_downloaded = on_downloaded
+        self.workers = max(1, workers)
+        self.per_host = max(1, per_host)
+        self.limiter = None
+        if max_rate:
+            self.limiter = BandwidthLimiter (max_rate)
+        self.condition = threading.Condition()
+        self.active = {}
+        self.running = 0
+        self.results = {}
+        self.transfers = Queue.Queue()
+        
+    # claim and download up to max_items queued images
+    # images are claimed a few at a time as workers free up, so other download nodes can 
+    # share the queue; returns when every transfer has finished
+    def run (self, max_items):
+        pending = []
+        claimed = 0
+        exhausted = False
+        logging.info ('Downloading with %s workers' % self.workers)
+        
+        # the same worker threads carry out every transfer, so each keeps its database 
+        # connection
+        threads = []
+        for i in range(self.workers):
+            t = threading.Thread (target=self._worker)
+            t.daemon = True
+            t.start ()
+            threads.append (t)
+        
+        with self.condition:
+            while pending or self.running or not exhausted:
+                if not exhausted and len(pending) < self.workers:
+                    items = self.processor._claim (status='NEW', new_status='DOWNLOADING', 
+                        limit=min(self.workers, max_items - claimed))
+                    pending.extend (items)
+                    claimed += len(items)
+                    exhausted = not items or claimed >= max_items
+                
+                item = self._dispatchable (pending)
+                if item is None:
+                    self.condition.wait (1)
+                    continue
+                    
+                item, host = item
+                pending.remove (item)
+                self.active[host] = self.active.get(host, 0) + 1
+                self.running += 1
+                
+                self.transfers.put ((item, host))
+        
+        for t in threads:
+            self.transfers.put (None)
+        for t in threads:
+            t.join ()
+        self.processor.esa.health.save ()
+        logging.info ('Download results: %s' % ', '.join(['%s %s' % (v, k) for k, v in self.results.items()]))
+        return self.results
+    
+    # first pending item, in queue order, that can be started without exceeding a limit, 
+    # together with the best mirror for it that has a free slot
+    def _dispatchable (self, pending):
+        if self.running >= self.workers:
+            return None
+        for item in pending:
+            for url in self.processor.esa.mirror_urls(item):
+                host = urlparse(url).hostname
+                if self.active.get(host, 0) < self.per_host:
+                    return item, host
+        return None
+    
+    def _worker (self):
+        while True:
+            transfer = self.transfers.get ()
+            if transfer is None:
+                break
+            self._transfer (*transfer)
+    
+    # failover to other mirrors happens within the slot reserved for host
+    def _transfer (self, item, host):
+        status = 'ERR_DOWNLOAD'
+        try:
+            dest_file = os.path.join(self.processor._archive_dir(item['name']), item['name'])
+            if self.processor.esa.download_product (item, dest_file, self.limiter, prefer_host=host):
+                status = 'DOWNLOADED'
+        except Exception, e:
+            logging.error ('Failed downloading %s: %s' % (item['name'], e))
+        
+        try:
+            if status == 'DOWNLOADED' and self.on_downloaded:
+                self.processor._update_image_status ('PROCESSING', item['id'], release=False)
+                self.on_downloaded (item)
+            else:
+                self.processor._update_image_status (status, item['id'])
+        except Exception, e:
+            # the image is requeued once its lease expires
+            logging.error ('Failed to hand on %s: %s' % (item['name'], e))
+            self.processor._drop_lease (item['id'])
+        finally:
+            with self.condition:
+                self.active[host] -= 1
+                self.running -= 1
+                self.results[status] = self.results.get(status, 0) + 1
+                self.condition.notify ()
+    
+
+# writes image footprints (pass, geo_extent and orbit_position) to the satimage table
+# orbit_position is worked out here from the footprint's centroid rather than by PostGIS
+# a single footprint is one UPDATE; a batch is copied into a temp staging table and applied 
+# with one UPDATE ... FROM
+class FootprintWriter:
+    def __init__ (self, db, table):
+        self.db = db
+        self.table = table
+    
+    # latitude of the centroid of the footprint polygon
+    @staticmethod
+    def centroid_lat (corners):
+        points = [(c['lng'], c['lat']) for c in corners]
+        points.append (points[0])
+        area = 0.0
+        cy = 0.0
+        for (x1, y1), (x2, y2) in zip(points[:-1], points[1:]):
+            cross = x1 * y2 - x2 * y1
+            area += cross
+            cy += (y1 + y2) * cross
+        if not area:
+            return sum([c['lat'] for c in corners]) / len(corners)
+        return cy / (3 * area)
+    
+    # position around the orbit in degrees, counted from the equator going north
+    @classmethod
+    def orbit_position (cls, pass_, corners):
+        lat = cls.centroid_lat (corners)
+        if pass_ == 'ASCENDING':
+            return lat if lat >= 0 else 360 + lat
+        if pass_ == 'DESCENDING':
+            return 180 - lat
+        return None
+    
+    def _wkt (self, corners):
+        poly = ['%(lng)s %(lat)s'%c for c in corners]
+        poly.append (poly[0])
+        return 'POLYGON((%s))' % ', '.join(poly)
+    
+    def write (self, image_id, pass_, corners):
+        sql = """update %s set pass = %%s, geo_extent = ST_GeomFromText(%%s, 4326), orbit_position = %%s 
+            where id = %%s""" % self.table
+        self.db.exec_sql (sql, [pass_, self._wkt(corners), self.orbit_position(pass_, corners), image_id])
+    
+    # write a list of (image_id, pass, corners) tuples, returning the number of images updated
+    def write_many (self, footprints):
+        if not footprints:
+            return 0
+        data = StringIO()
+        for image_id, pass_, corners in footprints:
+            orbit_position = self.orbit_position (pass_, corners)
+            data.write ('%s\t%s\t%s\t%s\n' % (image_id, pass_, self._wkt(corners), 
+                '\\N' if orbit_position is None else repr(orbit_position)))
+        data.seek (0)
+        
+        with self.db.transaction () as c:
+            c.execute ("""create temp table footprint_staging 
+                (id integer, pass varchar(20), wkt text, orbit_position double precision) on commit drop""")
+            c.copy_from (data, 'footprint_staging', columns=('id', 'pass', 'wkt', 'orbit_position'))
+            c.execute ("""update %s s set pass = f.pass, geo_extent = ST_GeomFromText(f.wkt, 4326), 
+                orbit_position = f.orbit_position from footprint_staging f where s.id = f.id""" % self.table)
+            return c.rowcount
+    
+
+# collects satimage_published rows and writes each batch with one upsert, replacing any 
+# earlier record with the same name
+# needs a unique index on the name:
+#   create unique index satimage_published_name on satimage_published (name)
+class PublishRecordWriter:
+    def __init__ (self, db, table, batch_size = 500):
+        self.db = db
+        self.table = table
+        self.batch_size = batch_size
+        self.rows = []
+        self.lock = threading.Lock()
+    
+    def add (self, source_image, name, url, image_type, corners):
+        poly = ['%(lng)s %(lat)s'%c for c in corners]
+        poly.append (poly[0])
+        wkt = 'POLYGON((%s))' % ', '.join(poly)
+        with self.lock:
+            self.rows.append ((source_image, image_type, url, name, wkt))
+            full = len(self.rows) >= self.batch_size
+        if full:
+            self.flush ()
+    
+    # write all pending rows, returning the number written
+    def flush (self):
+        with self.lock:
+            rows = self.rows
+            self.rows = []
+        if not rows:
+            return 0
+        
+        # a name may only appear once in an upsert - keep the last row for each
+        latest = {}
+        for row in rows:
+            latest[row[3]] = row
+        rows = [row for row in rows if latest[row[3]] is row]
+        
+        c = self.db.cursor()
+        values_sql = ','.join([c.mogrify("(%s,%s,%s,%s,ST_GeomFromText(%s, 4326))", row) for row in rows])
+        sql = """insert into %s (source_image, type, url, name, geo_extent) values %s 
+            on conflict (name) do update set source_image = excluded.source_image, type = excluded.type, 
+            url = excluded.url, geo_extent = excluded.geo_extent""" % (self.table, values_sql)
+        # a single statement, so the whole batch is written or none of it is
+        # if it fails the publish job is retried and adds its rows again
+        c.execute (sql)
+        logging.debug ('Wrote %s publish records' % len(rows))
+        return len(rows)
+    
+
+# durable queue of images waiting to be published, kept as one json file per image in a 
+# spool dir and drained by background uploader threads
+# a thread claims a job by renaming it into the working dir, so any number of threads and 
+# processes can share the spool; jobs left in the working dir by a dead process are put back 
+# once they haven't been touched for LEASE_TIMEOUT seconds
+# a job that fails is retried with backoff, its file's mtime holding the time of the next 
+# attempt, and after retries failures the image is set to ERR_PUBLISHING
+class PublishQueue:
+    def __init__ (self, processor, spool_dir, workers = 2, retries = 5):
+        self.processor = processor
+        self.spool_dir = spool_dir
+        self.working_dir = os.path.join(spool_dir, 'working')
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        self.workers = workers
+        self.retries = retries
+        self.stale_timeout = getattr(settings, 'LEASE_TIMEOUT', 600)
+        self.threads = []
+        self.active = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.last_recovery = 0
+        for d in (self.spool_dir, self.working_dir, self.failed_dir):
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    if not os.path.isdir(d):
+                        raise
+    
+    def _job_file (self, dir, name):
+        return os.path.join(dir, '%s.json' % name)
+    
+    def _write (self, path, job, not_before = None):
+        tempfile = os.path.join(self.spool_dir, '.%s.tmp' % os.path.basename(path))
+        f = open(tempfile, 'w')
+        try:
+            json.dump(job, f)
+        finally:
+            f.close()
+        if not_before:
+            os.utime (tempfile, (not_before, not_before))
+        replace_file (tempfile, path)
+    
+    # queue an image's artifacts for publishing, with the status the image was processed to
+    def put (self, item, status, artifacts):
+        job = {'id': item['id'], 'name': item['name'], 'status': status, 'artifacts': artifacts, 'attempts': 0}
+        self._write (self._job_file(self.spool_dir, item['name']), job)
+        with self.condition:
+            self.condition.notify ()
+    
+    def start (self):
+        if self.threads:
+            return
+        self.stopping = False
+        for i in range(self.workers):
+            t = threading.Thread (target=self._run)
+            t.daemon = True
+            t.start ()
+            self.threads.append (t)
+    
+    # wait until every job that is due has been published, then stop the threads
+    # jobs waiting to be retried stay in the spool for the next run
+    def close (self):
+        if not self.threads:
+            return
+        with self.condition:
+            # stop waiting if every thread has died, rather than waiting for work nobody will do
+            while (self.active or self._ready()) and [t for t in self.threads if t.is_alive()]:
+                self.condition.wait (1)
+            self.stopping = True
+            self.condition.notify_all ()
+        for t in self.threads:
+            t.join ()
+        self.threads = []
+    
+    def _ready (self):
+        now = time.time()
+        ready = []
+        for f in os.listdir(self.spool_dir):
+            if not f.endswith('.json'):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.spool_dir, f)) <= now:
+                    ready.append (f)
+            except OSError:
+                # claimed by another process since the listing
+                pass
+        return ready
+    
+    def _recover (self):
+        now = time.time()
+        if now - self.last_recovery < 60:
+            return
+        self.last_recovery = now
+        for f in os.listdir(self.working_dir):
+            path = os.path.join(self.working_dir, f)
+            try:
+                if now - os.path.getmtime(path) > self.stale_timeout:
+                    os.rename (path, os.path.join(self.spool_dir, f))
+                    logging.warning ('Requeued stale publish job %s' % f)
+            except OSError:
+                pass
+    
+    def _claim (self):
+        self._recover ()
+        for f in sorted(self._ready()):
+            path = os.path.join(self.working_dir, f)
+            try:
+                os.rename (os.path.join(self.spool_dir, f), path)
+            except OSError:
+                # another thread or process got there first
+                continue
+            os.utime (path, None)
+            return path
+        return None
+    
+    def _run (self):
+        while True:
+            with self.condition:
+                if self.stopping:
+                    break
+                try:
+                    path = self._claim ()
+                except (IOError, OSError), e:
+                    logging.error ('Failed to claim a publish job: %s' % e)
+                    path = None
+                if not path:
+                    self.condition.wait (1)
+                    continue
+                self.active += 1
+            try:
+                self._publish (path)
+            except Exception, e:
+                # the job stays in the working dir and is requeued once it goes stale
+                logging.exception ('Failed publishing %s' % os.path.basename(path))
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    self.condition.notify_all ()
+    
+    def _publish (self, path):
+        try:
+            f = open(path, 'r')
+            try:
+                job = json.load(f)
+            finally:
+                f.close()
+        except ValueError, e:
+            logging.error ('Unreadable publish job %s: %s' % (path, e))
+            replace_file (path, os.path.join(self.failed_dir, os.path.basename(path)))
+            return
+        
+        # keep touching the job while it's being uploaded so it isn't taken for stale
+        done = threading.Event()
+        def keep_alive ():
+            while not done.wait (self.stale_timeout / 3.0):
+                try:
+                    os.utime (path, None)
+                except OSError:
+                    break
+        toucher = threading.Thread (target=keep_alive)
+        toucher.daemon = True
+        toucher.start ()
+        try:
+            self.processor._publish_artifacts (job, job['artifacts'])
+        except Exception, e:
+            done.set ()
+            job['attempts'] += 1
+            if job['attempts'] > self.retries:
+                logging.error ('Giving up publishing %s: %s' % (job['name'], e))
+                self.processor._update_image_status ('ERR_PUBLISHING', job['id'])
+                replace_file (path, self._job_file(self.failed_dir, job['name']))
+                return
+            delay = min(60 * 2 ** (job['attempts'] - 1), 3600)
+            logging.warning ('Publishing %s failed, retrying in %s seconds: %s' % (job['name'], delay, e))
+            self._write (self._job_file(self.spool_dir, job['name']), job, time.time() + delay)
+            self._remove (path)
+            return
+        done.set ()
+        
+        if job['status'] == 'PROCESSED':
+            self.processor._update_image_status ('PUBLISHED', job['id'])
+        self._remove (path)
+        logging.info ('Published %s' % job['name'])
+    
+    def _remove (self, path):
+        try:
+            os.unlink (path)
+        except OSError, e:
+            logging.warning ('Failed to remove publish job %s: %s' % (path, e))
+    
+
+# static R-tree over (bbox, value) pairs, bulk loaded with Sort-Tile-Recursive packing
+# bboxes are (west, south, east, north)
+class StrTree:
+    def __init__ (self, items, capacity = 16):
+        self.capacity = capacity
+        nodes = [(bbox, value, None) for bbox, value in items]
+        while len(nodes) > capacity:
+            nodes = self._pack (nodes)
+        self.root = (self._bounds (nodes), None, nodes) if nodes else None
+    
+    def _bounds (self, nodes):
+        return (min([n[0][0] for n in nodes]), min([n[0][1] for n in nodes]), 
+            max([n[0][2] for n in nodes]), max([n[0][3] for n in nodes]))
+    
+    # group nodes into parents of up to capacity children: sort by x into vertical slices, 
+    # then by y within each slice
+    def _pack (self, nodes):
+        count = -(-len(nodes) // self.capacity)
+        slices = int(math.ceil(math.sqrt(count)))
+        slice_size = slices * self.capacity
+        nodes = sorted(nodes, key=lambda n: n[0][0] + n[0][2])
+        parents = []
+        for i in range(0, len(nodes), slice_size):
+            column = sorted(nodes[i:i + slice_size], key=lambda n: n[0][1] + n[0][3])
+            for j in range(0, len(column), self.capacity):
+                children = column[j:j + self.capacity]
+                parents.append ((self._bounds (children), None, children))
+        return parents
+    
+    # values whose bbox overlaps the given bbox
+    def query (self, bbox):
+        values = []
+        stack = [self.root] if self.root else []
+        while stack:
+            box, value, children = stack.pop()
+            if box[0] > bbox[2] or box[2] < bbox[0] or box[1] > bbox[3] or box[3] < bbox[1]:
+                continue
+            if children is None:
+                values.append (value)
+            else:
+                stack.extend (children)
+        return values
+
+
+# point in polygon by the even-odd rule over all rings, so holes are respected
+def point_in_rings (point, rings):
+    x, y = point
+    inside = False
+    for ring in rings:
+        for i in range(len(ring) - 1):
+            (x1, y1), (x2, y2) = ring[i], ring[i + 1]
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+    return inside
+
+# whether segments a-b and c-d cross or touch
+# a point on the line through the other segment only counts if it lies within that segment
+def _segments_cross (a, b, c, d):
+    def side (p, q, r):
+        v = (q[0] - p[0]) * (r[1] - p[1]) - (q[1] - p[1]) * (r[0] - p[0])
+        return (v > 0) - (v < 0)
+    def within (p, q, r):
+        return min(p[0], q[0]) <= r[0] <= max(p[0], q[0]) and min(p[1], q[1]) <= r[1] <= max(p[1], q[1])
+    s1, s2, s3, s4 = side(a, b, c), side(a, b, d), side(c, d, a), side(c, d, b)
+    if s1 * s2 < 0 and s3 * s4 < 0:
+        return True
+    return ((s1 == 0 and within(a, b, c)) or (s2 == 0 and within(a, b, d)) 
+        or (s3 == 0 and within(c, d, a)) or (s4 == 0 and within(c, d, b)))
+
+# whether two areas given as lists of closed rings (outer rings and holes) intersect
+# either an edge of one crosses an edge of the other, or one lies inside the other
+def rings_intersect (rings1, rings2):
+    for r1 in rings1:
+        for i in range(len(r1) - 1):
+            for r2 in rings2:
+                for j in range(len(r2) - 1):
+                    if _segments_cross (r1[i], r1[i + 1], r2[j], r2[j + 1]):
+                        return True
+    return point_in_rings (rings1[0][0], rings2) or point_in_rings (rings2[0][0], rings1)
+
+# rings of a WKT polygon or multipolygon as lists of (x, y)
+def parse_wkt_rings (wkt):
+    rings = []
+    for ring in re.findall (r'\(([^()]+)\)', wkt):
+        rings.append ([tuple([float(v) for v in p.split()[:2]]) for p in ring.split(',')])
+    return rings
+
+def _as_datetime (d):
+    if d is None or isinstance(d, datetime):
+        return d
+    return datetime(d.year, d.month, d.day)
+
+
+# all AOIs held in memory with an R-tree over their bboxes, so footprint and bbox queries 
+# don't each need a trip to PostGIS
+# the table is checked for changes at most every AOI_REFRESH_INTERVAL seconds and reloaded 
+# when its signature differs
+class AoiCatalogue:
+    def __init__ (self, db, table):
+        self.db = db
+        self.table = table
+        self.signature = None
+        self.checked = 0
+        self.aois = {}
+        self.tree = None
+        self.lock = threading.Lock()
+    
+    def _signature (self):
+        cur = self.db.cursor()
+        cur.execute ("""select count(*) as count, md5(string_agg(id || ':' || name || ':' || 
+            coalesce(begin_date::text, '') || ':' || coalesce(end_date::text, '') || ':' || 
+            md5(ST_AsBinary(the_geom)), ',' order by id)) as signature from %s""" % self.table)
+        row = cur.fetchone()
+        return '%s:%s' % (row['count'], row['signature'])
+    
+    def refresh (self):
+        with self.lock:
+            now = time.time()
+            if self.tree is not None and now - self.checked < getattr(settings, 'AOI_REFRESH_INTERVAL', 300):
+                return
+            self.checked = now
+            signature = self._signature()
+            if signature == self.signature:
+                return
+            
+            cur = self.db.cursor()
+            cur.execute ("""select id, name, begin_date, end_date, ST_AsText(the_geom) as wkt 
+                from %s where the_geom is not null""" % self.table)
+            aois = {}
+            for row in cur.fetchall():
+                rings = parse_wkt_rings (row['wkt'])
+                if not rings:
+                    continue
+                xs = [p[0] for r in rings for p in r]
+                ys = [p[1] for r in rings for p in r]
+                aois[row['name']] = {'id': row['id'], 'name': row['name'], 'rings': rings, 
+                    'begin_date': _as_datetime(row['begin_date']), 'end_date': _as_datetime(row['end_date']),
+                    'bbox': (min(xs), min(ys), max(xs), max(ys))}
+            self.aois = aois
+            self.tree = StrTree([(a['bbox'], a) for a in aois.values()])
+            self.signature = signature
+            logging.info ('Loaded %s AOIs from %s' % (len(aois), self.table))
+    
+    # AOIs whose geometry intersects a footprint polygon, given as a list of (lng, lat) 
+    # points, and whose date window contains the acquisition date
+    def intersecting (self, points, acquisition_date = None):
+        self.refresh ()
+        ring = list(points)
+        if ring[0] != ring[-1]:
+            ring.append (ring[0])
+        bbox = (min([p[0] for p in ring]), min([p[1] for p in ring]), max([p[0] for p in ring]), max([p[1] for p in ring]))
+        acquisition_date = _as_datetime(acquisition_date)
+        
+        found = []
+        for a in self.tree.query (bbox):
+            if acquisition_date and a['begin_date'] and acquisition_date < a['begin_date']:
+                continue
+            if acquisition_date and a['end_date'] and acquisition_date > a['end_date']:
+                continue
+            if rings_intersect ([ring], a['rings']):
+                found.append (a)
+        return sorted(found, key=lambda a: a['id'])
+    
+    def get (self, name):
+        self.refresh ()
+        return self.aois.get(name)
+        
+
 class AsarProcessor:
     db = None
     archive_dir = None
     s3_loader = None
     
     def __init__(self, archive_dir = settings.ARCHIVE_DIR, debug=False):
+        self.debug = debug
         self.db = GeoDatabase()
         self.db.connect ()
+        self._prepare_statements ()
         self.archive_dir  = archive_dir
-        self.esa = ESARollingArchive(debug=debug)
+        self.esa = ESARollingArchive(debug=debug, 
+            cache_file=getattr(settings, 'SCRAPE_CACHE_FILE', os.path.join(archive_dir, 'scrape-cache.json')),
+            health_file=getattr(settings, 'MIRROR_HEALTH_FILE', os.path.join(archive_dir, 'mirror-health.json')))
         self.satimage_table = 'satimage'
         self.aoi_table = 'satimage_aoi'
+        self.aois = AoiCatalogue(self.db, self.aoi_table)
+        self.worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.heartbeat = None
+        self.leases = set()
+        self.leases_lock = threading.Lock()
+        self.last_requeue = 0
+        self.artifact_cache = None
+        cache_dir = getattr(settings, 'ARTIFACT_CACHE_DIR', None)
+        if cache_dir:
+            self.artifact_cache = ArtifactCache(cache_dir, 
+                max_bytes=getattr(settings, 'ARTIFACT_CACHE_MAX_BYTES', 10 * 1024 ** 3),
+                stages=getattr(settings, 'ARTIFACT_CACHE_STAGES', None))
         self.s3Loader = S3Loader()
+        self.footprints = FootprintWriter(self.db, self.satimage_table)
+        self.publisher = PublishQueue(self, 
+            getattr(settings, 'PUBLISH_SPOOL_DIR', os.path.join(archive_dir, 'publish-spool')),
+            workers=getattr(settings, 'PUBLISH_WORKERS', 2),
+            retries=getattr(settings, 'PUBLISH_RETRIES', 5))
     
-    def scrape (self):
+    def scrape (self, full = False):
         
-        records = self.esa.scrape ()
+        records = self.esa.scrape (full=full)
         new_images = 0
         
         logging.info ('Scraped %s records from Envisat Rolling Archive' % (len(records)))
         
+        if not records:
+            self.esa.commit ()
+            return
+        
         table = self.satimage_table
-        sql = "select * from satimage where geo_extent is not null order by acquisition_date desc limit 3"
-        cur = self.db.cursor()    
-        cur.execute (sql)
-        reference_images = cur.fetchall ()
 
         logging.info ('Checking for new records to add...')
 
+        # the same image is often listed by more than one mirror - keep the first listing
+        unique = []
+        names = set()
         for record in records:
-            # check to see if this image already exists
-            if not self.db.item_exists(table, {'name': record['name']}):
-                # if not, then add it to the database
-                record['description'] = 'Envisat ASAR Radar satellite image acquired %s' % record['acquisition_date']
-                record['status'] = 'NEW'
-                
-                # compute the offset in orbital degrees from the last 3 known orbital locations
-                # and then derive an estiamted orbit positiion for the new image based on the time difference
-                abs_orbit_positions = []
-                for r in reference_images:
-                    time_delta = (record['acquisition_date'] + (record['duration']/2)) - (r['acquisition_date'] + (r['duration'] / 2))
-                    orbit_delta = (((time_delta.total_seconds() / 60) / 100.6))
-                    abs_orbit_positions.append ((r['orbit'] + (r['orbit_position']/360) + orbit_delta))
-
-                print abs_orbit_positions
-                s = sum(abs_orbit_positions)
-                l = len(abs_orbit_positions)
-                value = s/l * 360 % 360
-                record ['orbit_position'] = value
-                
-                # downgrade priority on images 
-                if (70 < record ['orbit_position'] < 110) or (240 < record ['orbit_position'] < 300):
-                    record['priority'] = 10
-                else:
-                    record['priority'] = 100
-                                    
-                id = self.db.insert_item (table, record)                                
-                new_images += 1
+            if record['name'] not in names:
+                names.add (record['name'])
+                unique.append (record)
+        
+        # check which of these images already exist with a single query
+        existing = self.db.existing_values (table, 'name', names)
+        new_records = [r for r in unique if r['name'] not in existing]
+        
+        if new_records:
+            sql = "select * from satimage where geo_extent is not null order by acquisition_date desc limit 3"
+            cur = self.db.cursor()    
+            cur.execute (sql)
+            reference_images = cur.fetchall ()
+
+        for record in new_records:
+            record['description'] = 'Envisat ASAR Radar satellite image acquired %s' % record['acquisition_date']
+            record['status'] = 'NEW'
+            
+            # compute the offset in orbital degrees from the last 3 known orbital locations
+            # and then derive an estiamted orbit positiion for the new image based on the time difference
+            abs_orbit_positions = []
+            for r in reference_images:
+                time_delta = (record['acquisition_date'] + (record['duration']/2)) - (r['acquisition_date'] + (r['duration'] / 2))
+                orbit_delta = (((time_delta.total_seconds() / 60) / 100.6))
+                abs_orbit_positions.append ((r['orbit'] + (r['orbit_position']/360) + orbit_delta))
+
+            print abs_orbit_positions
+            s = sum(abs_orbit_positions)
+            l = len(abs_orbit_positions)
+            value = s/l * 360 % 360
+            record ['orbit_position'] = value
+            
+            # downgrade priority on images 
+            if (70 < record ['orbit_position'] < 110) or (240 < record ['orbit_position'] < 300):
+                record['priority'] = 10
+            else:
+                record['priority'] = 100
+                                
+        # add all the new images to the database in one statement
+        new_images = self.db.insert_items (table, new_records)
 
         logging.info ('Added %s new images.' % (new_images))
+        self.esa.commit ()
 
 
     def _get_images (self, status = 'DOWNLOADED', limit = settings.MAX_PROCESS, name = None):
-        # get list of images to be processed
+        # get images to be processed, yielded as they are read
         if name:
-            sql = "select * from %s where name = '%s'" % (self.satimage_table, name)
+            sql = "select * from %s where name = %%s" % self.satimage_table
+            params = [name]
         else:
-            sql = "select * from %s where status = '%s' order by priority desc, acquisition_date asc limit %s" % (self.satimage_table, status, limit)
-        cur = self.db.cursor()    
-        cur.execute (sql)
-        return cur.fetchall ()
+            sql = "select * from %s where status = %%s order by priority desc, acquisition_date asc limit %%s" % self.satimage_table
+            params = [status, limit]
+        return self.db.stream (sql, params)
 
     def _next (self, status = 'DOWNLOADED', new_status = 'PROCESSING', name = None):
         # get next image to be processed
+        items = self._claim (status, new_status, limit=1, name=name)
+        if items:
+            return items[0]
+        return None
+    
+    # atomically claim up to limit images by switching them from status to new_status
+    # the candidate rows are locked with SKIP LOCKED and updated in the same statement, so
+    # workers running against the same database never claim the same image
+    # each claimed row gets a lease in the name of this worker that is kept alive by the
+    # heartbeat thread; leases that stop beating are returned to the queue by the next claim
+    # returns the claimed rows in queue order
+    #
+    # leases need these columns on the image table:
+    # alter table satimage add column claimed_by varchar(100), add column claimed_at timestamp, add column heartbeat_at timestamp
+    def _claim (self, status = 'DOWNLOADED', new_status = 'PROCESSING', limit = 1, name = None):
         if name:
-            sql = "select * from %s where name='%s' order by acquisition_date asc limit 1" % (self.satimage_table, name)
+            sql = self._claim_sql ("name = %s order by acquisition_date asc")
+            cur = self.db.cursor()    
+            cur.execute (sql, [new_status, self.worker_id, name, limit])
         else:
-            sql = "select * from %s where status = '%s' order by priority desc, acquisition_date asc limit 1" % (self.satimage_table, status)
+            self._requeue_expired (throttle=True)
+            cur = self.db.execute ('claim_next', [new_status, self.worker_id, status, limit])
+        items = cur.fetchall ()
+        items.sort (key=lambda i: (-(i['priority'] or 0), i['acquisition_date']))
+        if items:
+            with self.leases_lock:
+                self.leases.update ([i['id'] for i in items])
+            self._start_heartbeat ()
+        return items
+    
+    # stop renewing the lease on an image, so that if its status was never set it is 
+    # requeued once the lease expires
+    def _drop_lease (self, image_id):
+        with self.leases_lock:
+            self.leases.discard (image_id)
+    
+    def _claim_sql (self, where_sql):
+        return """
+update %(table)s set status = %%s, claimed_by = %%s, claimed_at = now(), heartbeat_at = now()
+where id in (select id from %(table)s where %(where)s limit %%s for update skip locked)
+returning *""" % {'table': self.satimage_table, 'where': where_sql}
+    
+    # the queue and status statements every worker runs over and over are prepared once per 
+    # connection
+    def _prepare_statements (self):
+        self.db.prepare ('claim_next', 
+            self._claim_sql ("status = %s order by priority desc, acquisition_date asc"))
+        status_sql = """update %(table)s set status = %%s %(lease)s
+where id = %%s and (claimed_by is null or claimed_by = %%s)"""
+        self.db.prepare ('update_status', status_sql % {'table': self.satimage_table, 
+            'lease': ', claimed_by = null, claimed_at = null, heartbeat_at = null'})
+        self.db.prepare ('update_status_keep_lease', status_sql % {'table': self.satimage_table, 'lease': ''})
+        self.db.prepare ('heartbeat', 
+            "update %s set heartbeat_at = now() where claimed_by = %%s and id = any(%%s)" % self.satimage_table)
+    
+    # put images whose lease has expired back in the queue they were claimed from
+    # with include_unleased, also requeue in-progress images that have no lease at all, such as 
+    # ones left behind by a worker that predates leases
+    # with throttle, do nothing if this was already checked within the last heartbeat interval
+    def _requeue_expired (self, include_unleased = False, throttle = False):
+        interval = getattr(settings, 'HEARTBEAT_INTERVAL', 60)
+        if throttle and time.time() - self.last_requeue < interval:
+            return []
+        self.last_requeue = time.time()
+        
+        unleased_sql = ''
+        if include_unleased:
+            unleased_sql = 'or heartbeat_at is null'
+        sql = """
+update %(table)s set status = case status when 'DOWNLOADING' then 'NEW' else 'DOWNLOADED' end,
+    claimed_by = null, claimed_at = null, heartbeat_at = null
+where status in ('DOWNLOADING', 'PROCESSING') 
+and (heartbeat_at < now() - %%s * interval '1 second' %(unleased)s)
+returning name, status, id""" % {'table': self.satimage_table, 'unleased': unleased_sql}
         cur = self.db.cursor()    
-        cur.execute (sql)
-        next = cur.fetchone ()
-        if next:
-            sql = "update %s set status = '%s' where id = %s" % (self.satimage_table, new_status, next['id'])
-            cur.execute (sql)
-        return next    
+        cur.execute (sql, [getattr(settings, 'LEASE_TIMEOUT', 600)])
+        items = cur.fetchall ()
+        for item in items:
+            logging.warning ('Returned %s to the %s queue after its claim expired' % (item['name'], item['status']))
+        return items
+    
+    # keep the leases on the images this worker is still working on alive until they are 
+    # released or dropped
+    def _start_heartbeat (self):
+        if self.heartbeat and self.heartbeat.is_alive():
+            return
+        self.heartbeat = threading.Thread (target=self._heartbeat)
+        self.heartbeat.daemon = True
+        self.heartbeat.start ()
     
-    def _archive_dir (self, image_name):
+    def _heartbeat (self):
+        interval = getattr(settings, 'HEARTBEAT_INTERVAL', 60)
+        while True:
+            time.sleep (interval)
+            with self.leases_lock:
+                ids = list(self.leases)
+            if not ids:
+                continue
+            try:
+                self.db.execute ('heartbeat', [self.worker_id, ids])
+            except psycopg2.Error, e:
+                logging.error ('Failed to renew leases: %s' % e)
+    
+    # indexes the queue, intersection and publishing queries rely on, each with the table, 
+    # access method, columns (with their sort order), whether it must be unique, the predicate 
+    # of a partial index as PostgreSQL shows it (without casts), and the sql to create it
+    # %(concurrently)s is left out when the table is partitioned, as partitioned tables can't 
+    # be indexed concurrently, and a unique index on a partitioned table has to include the 
+    # partition key
+    def _schema_indexes (self, partitioned = False):
+        args = {'satimage': self.satimage_table, 'aoi': self.aoi_table, 
+            'concurrently': '' if partitioned else 'concurrently',
+            'name_key': 'name, acquisition_date' if partitioned else 'name'}
+        name_key = ['name', 'acquisition_date'] if partitioned else ['name']
+        indexes = [
+            ('satimage_geo_extent_gist', self.satimage_table, 'gist', ['geo_extent'], False, None,
+                "create index %(concurrently)s if not exists satimage_geo_extent_gist on %(satimage)s using gist (geo_extent)"),
+            ('satimage_queue', self.satimage_table, 'btree', ['status', 'priority desc', 'acquisition_date'], False, 
+                "status = any (array['NEW', 'DOWNLOADED'])",
+                """create index %(concurrently)s if not exists satimage_queue on %(satimage)s (status, priority desc, acquisition_date) 
+                where status in ('NEW', 'DOWNLOADED')"""),
+            ('satimage_name', self.satimage_table, 'btree', name_key, True, None,
+                "create unique index %(concurrently)s if not exists satimage_name on %(satimage)s (%(name_key)s)"),
+            ('satimage_claimed_by', self.satimage_table, 'btree', ['claimed_by'], False, 'claimed_by is not null',
+                "create index %(concurrently)s if not exists satimage_claimed_by on %(satimage)s (claimed_by) where claimed_by is not null"),
+            ('satimage_aoi_the_geom_gist', self.aoi_table, 'gist', ['the_geom'], False, None,
+                "create index concurrently if not exists satimage_aoi_the_geom_gist on %(aoi)s using gist (the_geom)"),
+            ('satimage_published_name', 'satimage_published', 'btree', ['name'], True, None,
+                "create unique index concurrently if not exists satimage_published_name on satimage_published (name)"),
+        ]
+        return [{'name': name, 'table': table, 'method': method, 'columns': columns, 'unique': unique, 
+            'predicate': predicate, 'sql': sql % args} for name, table, method, columns, unique, predicate, sql in indexes]
+    
+    # the indexes that exist on the given tables, with their access method, key columns 
+    # (followed by desc where they sort descending), uniqueness, validity and predicate
+    def _existing_indexes (self, tables):
+        cur = self.db.cursor()
+        cur.execute ("""select t.relname as table_name, i.relname as name, am.amname as method, x.indisunique as is_unique, 
+            x.indisvalid as valid, pg_get_expr(x.indpred, x.indrelid) as predicate,
+            array(select a.attname || case when x.indoption[k.n - 1] & 1 = 1 then ' desc' else '' end 
+                from unnest(x.indkey) with ordinality k(attnum, n) 
+                join pg_attribute a on a.attrelid = x.indrelid and a.attnum = k.attnum order by k.n) as columns
+            from pg_index x join pg_class i on i.oid = x.indexrelid join pg_class t on t.oid = x.indrelid 
+            join pg_am am on am.oid = i.relam join pg_namespace n on n.oid = t.relnamespace
+            where n.nspname = current_schema() and t.relname = any(%s)""", [list(tables)])
+        return cur.fetchall ()
+    
+    # an existing index does the job of a wanted one if it is on the same table and columns 
+    # in the same order with the same access method, is unique if it has to be, and is 
+    # either complete or partial with the wanted predicate
+    def _index_matches (self, wanted, index):
+        return (index['table_name'] == wanted['table'] and index['method'] == wanted['method'] 
+            and list(index['columns']) == wanted['columns'] 
+            and (index['is_unique'] or not wanted['unique'])
+            and (not index['predicate'] or (wanted['predicate'] is not None 
+                and self._normalize_predicate (index['predicate']) == self._normalize_predicate (wanted['predicate']))))
+    
+    # a predicate without casts, brackets, spaces or case, so the text PostgreSQL shows for 
+    # an index can be compared with the one it was created from
+    def _normalize_predicate (self, predicate):
+        predicate = re.sub (r'::(character varying|double precision|timestamp with(out)? time zone|[a-z_]+)(\[\])?', '', predicate.lower())
+        return re.sub (r'[\s()]', '', predicate)
+    
+    def _is_partitioned (self):
+        cur = self.db.cursor()
+        cur.execute ("select 1 from pg_partitioned_table p join pg_class c on c.oid = p.partrelid where c.relname = %s", 
+            [self.satimage_table])
+        return cur.fetchone () is not None
+    
+    # create the lease columns and supporting indexes, optionally partitioning the image 
+    # table by acquisition month first, then report on them
+    # with check, nothing is changed
+    def schema (self, check = False, partition = False):
+        if not check:
+            self.db.exec_sql ("""alter table %s add column if not exists claimed_by varchar(100), 
+                add column if not exists claimed_at timestamp, add column if not exists heartbeat_at timestamp""" % self.satimage_table)
+            if partition:
+                self._partition_by_month ()
+        
+        partitioned = self._is_partitioned ()
+        wanted = self._schema_indexes (partitioned)
+        existing = self._existing_indexes (set([w['table'] for w in wanted]))
+        
+        for w in wanted:
+            matches = [i for i in existing if self._index_matches (w, i)]
+            valid = [i for i in matches if i['valid']]
+            if valid:
+                logging.info ('Index %s on %s: ok (%s)' % (w['name'], w['table'], valid[0]['name']))
+                continue
+            
+            # a failed concurrent build leaves an invalid index behind
+            invalid = [i['name'] for i in matches] + [i['name'] for i in existing 
+                if i['name'] == w['name'] and not i['valid'] and i not in matches]
+            for name in invalid:
+                if check:
+                    logging.warning ('Index %s on %s: INVALID' % (name, w['table']))
+                else:
+                    logging.info ('Dropping invalid index %s...' % name)
+                    concurrently = '' if partitioned and w['table'] == self.satimage_table else 'concurrently'
+                    self.db.exec_sql ('drop index %s if exists %s' % (concurrently, name))
+            if check:
+                if not invalid:
+                    logging.warning ('Index %s on %s: MISSING' % (w['name'], w['table']))
+            else:
+                logging.info ('Creating index %s on %s...' % (w['name'], w['table']))
+                self.db.exec_sql (w['sql'])
+        
+        self._report_tables ()
+    
+    # dead row counts and scan counts from the statistics collector
+    def _report_tables (self):
+        cur = self.db.cursor()
+        cur.execute ("""select relname, n_live_tup, n_dead_tup, seq_scan, idx_scan, last_autovacuum, 
+            pg_total_relation_size(relid) as size from pg_stat_user_tables 
+            where relname = %s or relname like %s or relname in (%s, 'satimage_published')""", 
+            [self.satimage_table, self.satimage_table + '_y%', self.aoi_table])
+        for row in cur.fetchall():
+            rows = row['n_live_tup'] + row['n_dead_tup']
+            dead = float(row['n_dead_tup']) / rows if rows else 0
+            logging.info ('%(relname)s: %(n_live_tup)s rows, %(size)s bytes, %(seq_scan)s seq scans, %(idx_scan)s index scans, last autovacuum %(last_autovacuum)s' % row)
+            if dead > getattr(settings, 'SCHEMA_BLOAT_THRESHOLD', 0.2):
+                logging.warning ('%s: %.0f%% of rows are dead, consider VACUUM' % (row['relname'], dead * 100))
+    
+    # turn the image table into one partitioned by acquisition month (needs PostgreSQL 11)
+    # the old table is renamed to <table>_unpartitioned and its rows copied across; running 
+    # this again on a partitioned table just adds partitions for any months still missing, 
+    # up to SCHEMA_PARTITION_MONTHS_AHEAD months from now
+    # a month can't be added while the default partition holds rows for it, so the default 
+    # partition is detached while the months are added, its rows for them moved across, and 
+    # then attached again
+    def _partition_by_month (self):
+        table = self.satimage_table
+        with self.db.transaction () as cur:
+            if not self._is_partitioned ():
+                logging.info ('Partitioning %s by acquisition month...' % table)
+                cur.execute ("alter table %s rename to %s_unpartitioned" % (table, table))
+                # rows without a date have no partition key, so can't be in the primary key
+                cur.execute ("select count(*) as n from %s_unpartitioned where acquisition_date is null" % table)
+                if cur.fetchone()['n']:
+                    raise Error('%s has images without an acquisition_date, which cannot be partitioned' % table)
+                # free the index and primary key names for the new table
+                cur.execute ("alter index if exists %s_pkey rename to %s_pkey_unpartitioned" % (table, table))
+                for index in self._schema_indexes ():
+                    if index['table'] == table:
+                        cur.execute ("alter index if exists %s rename to %s_unpartitioned" % (index['name'], index['name']))
+                cur.execute ("""create table %s (like %s_unpartitioned including defaults) 
+                    partition by range (acquisition_date)""" % (table, table))
+                # the primary key of a partitioned table has to include the partition key
+                cur.execute ("alter table %s add primary key (id, acquisition_date)" % table)
+                # keep the id sequence when the old table is dropped
+                cur.execute ("select pg_get_serial_sequence(%s, 'id') as seq", ['%s_unpartitioned' % table])
+                seq = cur.fetchone()['seq']
+                if seq:
+                    cur.execute ("alter sequence %s owned by %s.id" % (seq, table))
+                source = '%s_unpartitioned' % table
+            else:
+                source = None
+            
+            cur.execute ("select min(acquisition_date) as first from %s" % (source or table))
+            first = cur.fetchone()['first'] or datetime.utcnow()
+            month = datetime(first.year, first.month, 1)
+            
+            cur.execute ("""select nullif(partdefid, 0)::regclass::text as name from pg_partitioned_table 
+                where partrelid = %s::regclass""", [table])
+            default = cur.fetchone()['name']
+            if default:
+                cur.execute ("alter table %s detach partition %s" % (table, default))
+            
+            end = datetime.utcnow() + timedelta(days=31 * getattr(settings, 'SCHEMA_PARTITION_MONTHS_AHEAD', 3))
+            start = month
+            while month <= end:
+                following = datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+                cur.execute ("""create table if not exists %s_y%04dm%02d partition of %s 
+                    for values from (%%s) to (%%s)""" % (table, month.year, month.month, table), [month, following])
+                month = following
+            
+            if default:
+                cur.execute ("""with moved as (delete from %s where acquisition_date >= %%s and acquisition_date < %%s returning *)
+                    insert into %s select * from moved""" % (default, table), [start, month])
+                if cur.rowcount:
+                    logging.info ('Moved %s rows from %s into their monthly partitions' % (cur.rowcount, default))
+                cur.execute ("alter table %s attach partition %s default" % (table, default))
+            else:
+                cur.execute ("create table %s_default partition of %s default" % (table, table))
+            
+            if source:
+                cur.execute ("insert into %s select * from %s" % (table, source))
+                logging.info ('Copied %s rows into partitions; %s can be dropped once checked' % (cur.rowcount, source))
+                self._report_dependents (cur, source)
+    
+    # foreign keys and views still point at the old table after the rename, and have to be 
+    # moved by hand: a foreign key to the partitioned table needs acquisition_date as well
+    def _report_dependents (self, cur, source):
+        cur.execute ("""select conrelid::regclass::text as table_name, conname as name from pg_constraint 
+            where contype = 'f' and confrelid = %s::regclass""", [source])
+        for row in cur.fetchall():
+            logging.warning ('Foreign key %s on %s still references %s' % (row['name'], row['table_name'], source))
+        cur.execute ("""select distinct r.ev_class::regclass::text as view from pg_depend d 
+            join pg_rewrite r on r.oid = d.objid 
+            where d.classid = 'pg_rewrite'::regclass and d.refobjid = %s::regclass and r.ev_class <> %s::regclass""", [source, source])
+        for row in cur.fetchall():
+            logging.warning ('View %s still selects from %s' % (row['view'], source))
+    
+    # requeue every image left in progress by a dead worker, including ones with no lease
+    def recover (self):
+        items = self._requeue_expired (include_unleased=True)
+        logging.info ('Requeued %s images.' % len(items))
+    
+    def _archive_dir (self, image_name, create = True):
         path = os.path.join(self.archive_dir, image_name[14:18], image_name[18:20], image_name[20:22], image_name)
         
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if create and not os.path.exists(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                # another download thread may have just created it
+                if not os.path.isdir(path):
+                    raise
             
         return path        
     
@@ -717,21 +2714,37 @@ class AsarProcessor:
         return 's3://satimage/ASAR/%s/%s/%s/%s/' % (image_name[14:18], image_name[18:20], image_name[20:22], image_name)
 
     
-    def _update_image_status (self, status, image_id):
-        sql = "update %s set status = '%s' where id = '%s'" % (self.satimage_table, status, image_id)
-        cur = self.db.cursor()    
-        cur.execute (sql)
+    # set the final status of an image and release this worker's lease on it
+    # with release=False the lease is kept, to hand the image on to another stage of this worker
+    # the update is skipped if the lease expired and the image was claimed by another worker
+    # once released the lease is no longer renewed, even if the update failed
+    def _update_image_status (self, status, image_id, release = True):
+        statement = 'update_status' if release else 'update_status_keep_lease'
+        try:
+            if not self.db.execute (statement, [status, image_id, self.worker_id]).rowcount:
+                logging.warning ('Image %s was claimed by another worker, not setting status to %s' % (image_id, status))
+        finally:
+            if release:
+                self._drop_lease (image_id)
     
-    def download (self, name = None):
+    def download (self, name = None, workers = None):
     
         logging.info ("Downloading new images...")
         
+        if not name:
+            pool = DownloadPool (self, 
+                workers or getattr(settings, 'DOWNLOAD_WORKERS', 4),
+                getattr(settings, 'DOWNLOAD_PER_HOST', 2),
+                getattr(settings, 'DOWNLOAD_MAX_RATE', 0))
+            pool.run (settings.MAX_DOWNLOAD)
+            return
+        
         item = self._next (status='NEW', new_status='DOWNLOADING', name=name)
         while item:
 
             dest_file = os.path.join(self._archive_dir(item['name']), item['name'])
 #            print dest_file                         
-            result = self.esa.download_image (item['url'], dest_file)
+            result = self.esa.download_product (item, dest_file)
             if result:
                 status = 'DOWNLOADED'
             else:
@@ -743,154 +2756,408 @@ class AsarProcessor:
                 item = self._next (status='NEW', new_status='DOWNLOADING')
             else:
                 item = None
+        
+        self.esa.health.save ()
+
+    # run scrape, download, process and publish as connected stages
+    # each image moves on to the next stage as soon as it is ready; the queues between the 
+    # stages are bounded so downloads stop while processing is behind
+    def pipeline (self, aoi=None, auto_cleanup=True, workers=None, full=False):
+        queue_size = getattr(settings, 'PIPELINE_QUEUE_SIZE', 2)
+        process_queue = Queue.Queue (queue_size)
+        
+        self.scrape (full=full)
+        
+        self.publisher.start ()
+        stage_threads = []
+        for i in range(workers or getattr(settings, 'PIPELINE_PROCESS_WORKERS', 2)):
+            stage_threads.append (threading.Thread (target=self._pipeline_process, 
+                args=(process_queue, aoi, auto_cleanup)))
+        # images downloaded by earlier runs are fed in alongside the new downloads
+        backlog = threading.Thread (target=self._pipeline_backlog, args=(process_queue,))
+        for t in stage_threads + [backlog]:
+            t.daemon = True
+            t.start ()
+        
+        pool = DownloadPool (self, 
+            getattr(settings, 'DOWNLOAD_WORKERS', 4),
+            getattr(settings, 'DOWNLOAD_PER_HOST', 2),
+            getattr(settings, 'DOWNLOAD_MAX_RATE', 0),
+            on_downloaded=process_queue.put)
+        pool.run (settings.MAX_DOWNLOAD)
+        backlog.join ()
+        
+        # shut the stages down in order once everything upstream has drained
+        for t in stage_threads:
+            process_queue.put (None)
+        for t in stage_threads:
+            t.join ()
+        self.publisher.close ()
+    
+    # claim the images left DOWNLOADED by earlier runs one at a time, so no more are held 
+    # than the process queue has room for
+    def _pipeline_backlog (self, process_queue):
+        count = 0
+        while True:
+            try:
+                item = self._next (status='DOWNLOADED', new_status='PROCESSING')
+            except Exception, e:
+                logging.exception ('Failed to claim downloaded images')
+                break
+            if not item:
+                break
+            process_queue.put (item)
+            count += 1
+        logging.info ('Queued %s images downloaded earlier' % count)
+    
+    # every failure is caught, as a dead stage thread would leave the downloads blocked on 
+    # a full process queue
+    def _pipeline_process (self, process_queue, aoi, auto_cleanup):
+        while True:
+            item = process_queue.get ()
+            if item is None:
+                break
+            try:
+                try:
+                    status, error, artifacts = self.process_item (item, aoi, auto_cleanup)
+                except Exception, e:
+                    logging.exception ('Failed processing %s' % item['name'])
+                    status, artifacts = 'ERR_PROCESSING', []
+                self._update_image_status (status, item['id'])
+                self.publisher.put (item, status, artifacts)
+            except Exception, e:
+                # the lease is no longer renewed, so the image is requeued once it expires
+                self._drop_lease (item['id'])
+                logging.exception ('Failed to hand on %s' % item['name'])
+    
+    # intersections of one image are found with the in-memory AOI catalogue, using the 
+    # image's footprint corners if they are given (or its geo_extent from the database)
+    # queries across all images are left to PostGIS, and their rows are yielded as they are 
+    # read, so callers should only iterate over the result
+    def find_intersections (self, name=None, aoi=None, item=None, corners=None):
 
-    def find_intersections (self, name=None, aoi=None):
-
-        sql = """select i.name as image_name, a.id as aoi_id, a.name as aoi_name, i.status as status 
-            from %(satimage_table)s i join %(aoi_table)s a 
-            on ST_Intersects(i.geo_extent, a.the_geom)
-            and (a.begin_date is null or i.acquisition_date >= a.begin_date)
-            and (a.end_date is null or i.acquisition_date <= a.end_date)
-            """ % {'satimage_table' : self.satimage_table, 'aoi_table': self.aoi_table}
-        
-        where = []
-        if name: where.append (('i.name', name)) 
-        if aoi: where.append (('a.name', aoi))
-        if where:
-            sql += " WHERE " 
-            sql += ' AND '.join(["%s = '%s'" % w for w in where])
-        cur = self.db.cursor()    
-        cur.execute (sql)
-        items = cur.fetchall ()
-
-        logging.info ('Found %s intersections for image [%s] and AOI [%s]'%(len(items), name or 'any', aoi or 'any'))
+        if name:
+            items = self._image_intersections (name, aoi, item, corners)
+            logging.info ('Found %s intersections for image [%s] and AOI [%s]'%(len(items), name, aoi or 'any'))
+            return items
+        else:
+            sql = """select i.name as image_name, a.id as aoi_id, a.name as aoi_name, i.status as status 
+                from %(satimage_table)s i join %(aoi_table)s a 
+                on ST_Intersects(i.geo_extent, a.the_geom)
+                and (a.begin_date is null or i.acquisition_date >= a.begin_date)
+                and (a.end_date is null or i.acquisition_date <= a.end_date)
+                """ % {'satimage_table' : self.satimage_table, 'aoi_table': self.aoi_table}
+            
+            params = []
+            if aoi:
+                sql += " WHERE a.name = %s"
+                params.append (aoi)
+            return self._stream_intersections (sql, params, aoi)
+    
+    def _stream_intersections (self, sql, params, aoi):
+        count = 0
+        for item in self.db.stream (sql, params):
+            count += 1
+            yield item
+        logging.info ('Found %s intersections for image [any] and AOI [%s]'%(count, aoi or 'any'))
+    
+    def _image_intersections (self, name, aoi=None, item=None, corners=None):
+        if item is None or corners is None:
+            cur = self.db.cursor()
+            cur.execute ("select name, status, acquisition_date, ST_AsText(geo_extent) as wkt from %s where name = %%s" % self.satimage_table, 
+                [name])
+            item = cur.fetchone ()
+            if not item or not item['wkt']:
+                return []
+            points = parse_wkt_rings (item['wkt'])[0]
+        else:
+            points = [(float(c['lng']), float(c['lat'])) for c in corners]
         
+        items = []
+        for a in self.aois.intersecting (points, item['acquisition_date']):
+            if aoi and a['name'] != aoi:
+                continue
+            items.append ({'image_name': name, 'aoi_id': a['id'], 'aoi_name': a['name'], 'status': item['status']})
         return items
 
     def aoi_footprint (self, aoi):
-        sql = "select ST_Ymax(the_geom) as bbox_lat1, ST_Xmin(the_geom) as bbox_lng1, ST_Ymin(the_geom) as bbox_lat2,  ST_Xmax(the_geom) as bbox_lng2 from %s where name = '%s'" % (self.aoi_table, aoi)
-        cur = self.db.cursor()    
-        cur.execute (sql)
-        item = cur.fetchone ()
-        return item
+        a = self.aois.get (aoi)
+        if not a:
+            return None
+        west, south, east, north = a['bbox']
+        return {'bbox_lat1': north, 'bbox_lng1': west, 'bbox_lat2': south, 'bbox_lng2': east}
 
 
     def process_aoi(self, aoi):
-        images = self.find_intersections(aoi=aoi)
+        logging.info ('Processing images that intersect with AOI [%s]' % aoi) 
         
-        if images:
-            logging.info ('Processing %s images that intersect with AOI [%s]' % (len(images), aoi)) 
-            for image in images:
-                logging.info (image) 
-                self.process(name=image['image_name'], aoi=aoi)
-        else:
+        # the names are read first, as processing changes the rows being streamed
+        names = [image['image_name'] for image in self.find_intersections(aoi=aoi)]
+        for name in names:
+            logging.info (name) 
+            self.process(name=name, aoi=aoi)
+        if not names:
             logging.error ('Found no images that intersect with AOI [%s]' % (aoi)) 
             
-    def _publish_image (self, source_image, name, filename, image_type, corners):
-        s3_path = self._s3_path (source_image)
-        url = self.s3Loader.put_file (filename, '%s%s' % (s3_path, os.path.basename(filename) ))   
-        poly = ['%(lng)s %(lat)s'%c for c in corners]
-        poly.append (poly[0])
-        poly_sql = ', '. join(poly)
-        poly_sql = "ST_GeomFromText('SRID=4326;POLYGON((%s))')" % poly_sql
-        
-        values_sql = "%s,%s,%s,%s," + poly_sql        
-        sql = "insert into satimage_published (source_image, type, url, name, geo_extent) values (%s)" % values_sql
+    # each caller gets its own record writer, so a publish thread only ever writes - and 
+    # only sees the failure of - its own rows
+    def _record_writer (self):
+        return PublishRecordWriter(self.db, 'satimage_published', 
+            getattr(settings, 'PUBLISH_RECORD_BATCH', 500))
     
-        self.db.exec_sql("delete from satimage_published where name= %s", [name] )    
-        self.db.exec_sql(sql, [source_image, image_type, url, name])
+    # with records, the row is added to that writer for the caller to flush
+    def _publish_image (self, source_image, name, filename, image_type, corners, url = None, records = None):
+        if not url:
+            url = self.s3Loader.put_file (filename, self._s3_uri (source_image, filename))   
+        writer = records or self._record_writer ()
+        writer.add (source_image, name, url, image_type, corners)
+        if not records:
+            writer.flush ()
         
+    
+    # fill in footprints read from the headers of downloaded N1 files, for images that have 
+    # none or for every downloaded image with full
+    def footprint (self, name = None, full = False):
+        sql = "select id, name from %s where status not in ('NEW', 'DOWNLOADING', 'ERR_DOWNLOAD')" % self.satimage_table
+        params = []
+        if name:
+            sql += " and name = %s"
+            params.append (name)
+        elif not full:
+            sql += " and geo_extent is null"
+        cur = self.db.cursor()
+        cur.execute (sql, params)
+        items = cur.fetchall ()
+        logging.info ('Reading footprints for %s images' % len(items))
         
+        batch_size = getattr(settings, 'FOOTPRINT_BATCH', 500)
+        batch = []
+        updated = 0
+        for item in items:
+            n1_file = os.path.join(self._archive_dir(item['name'], create=False), item['name'])
+            try:
+                fields = N1Header(n1_file).footprint_fields ()
+            except (Error, IOError, ValueError, KeyError, struct.error), e:
+                logging.warning ('Unable to read footprint from %s: %s' % (n1_file, e))
+                continue
+            batch.append ((item['id'], fields['pass'], footprint_corners(fields)))
+            if len(batch) >= batch_size:
+                updated += self.footprints.write_many (batch)
+                batch = []
+        updated += self.footprints.write_many (batch)
+        logging.info ('Updated footprints for %s images' % updated)
     
-    def process(self, name=None, aoi=None, auto_cleanup=True):
+    # process downloaded images until the queue is empty
+    # with workers > 1 the images are shared between that many worker processes
+    # returns a list with the name, final status and any error for each image processed
+    def process(self, name=None, aoi=None, auto_cleanup=True, workers=None):
         
         # get list of images to be processed
 #        items = self._get_images(status='DOWNLOADED', limit=settings.MAX_PROCESS, name=name)
 #        logging.info ('Found %s images to process'%len(items))
 
-        cur = self.db.cursor()    
+        if workers > 1 and not name:
+            return self._process_parallel (workers, aoi, auto_cleanup)
         
+        # artifacts are published in the background while the next image is processed
+        self.publisher.start ()
+        results = []
         item = self._next (status='DOWNLOADED', new_status='PROCESSING', name=name)
         while item:
+            status, error, artifacts = self.process_item (item, aoi, auto_cleanup)
+            results.append ({'name': item['name'], 'status': status, 'error': error})
+            
+            # the status is set before queueing so a fast upload can't be overwritten
+            self._update_image_status (status, item['id'])
+            self.publisher.put (item, status, artifacts)
+            if not name:
+                item = self._next (status='DOWNLOADED', new_status='PROCESSING')
+            else:
+                item = None
+        self.publisher.close ()
+        return results
+    
+    # publish anything left in the publish queue by earlier runs
+    def publish (self):
+        self.publisher.start ()
+        self.publisher.close ()
+    
+    # run process() in a pool of worker processes, each with its own database connection,
+    # and log a summary of what they did
+    def _process_parallel (self, workers, aoi, auto_cleanup):
+        logging.info ('Processing with %s worker processes' % workers)
+        pool = multiprocessing.Pool (workers)
+        try:
+            # map_async so that the wait can be interrupted
+            batches = pool.map_async (_process_worker, [(aoi, auto_cleanup, self.debug)] * workers).get (9999999)
+        finally:
+            pool.close ()
+            pool.join ()
+        
+        results = []
+        for batch in batches:
+            results.extend (batch)
+        
+        counts = {}
+        for r in results:
+            counts[r['status']] = counts.get(r['status'], 0) + 1
+            if r['error']:
+                logging.error ('%s: %s' % (r['name'], r['error']))
+        logging.info ('Processed %s images: %s' % (len(results), ', '.join(['%s %s' % (v, k) for k, v in counts.items()])))
+        return results
+    
+    # process a single claimed image
+    # returns a tuple of (status, error message, artifacts), where artifacts lists the products 
+    # generated for the image that still need to be published - even if processing later failed
+    def process_item (self, item, aoi=None, auto_cleanup=True):
         
-            logging.info ('Processing %s'%item['name'])
+        logging.info ('Processing %s'%item['name'])
 
-            archive_dir=self._archive_dir(item['name'])
-            
-            n1_file = os.path.join(archive_dir, item['name'])
+        archive_dir=self._archive_dir(item['name'])
+        
+        n1_file = os.path.join(archive_dir, item['name'])
 
-            image = AsarImageFile(EnvisatBest(auto_cleanup), n1_file)
+        image = AsarImageFile(EnvisatBest(auto_cleanup), n1_file, self.artifact_cache)
+        
+        status = 'PROCESSED'
+        error = None
+        artifacts = []
+        try:
+            # extract footprint and store it in the database
+            footprint = image.extract_footprint ()
             
-            status = 'PROCESSED'
-            try:
-                # extract header
-                image.extract_header ()
-                
-                # extract footprint and store it in the database
-                footprint = image.extract_footprint ()
-                
-                logging.debug (footprint)
-                
-                if footprint:
-                    poly = ['%(lng)s %(lat)s'%c for c in footprint['corners']]
-                    poly.append (poly[0])
-                    poly_sql = ', '. join(poly)
-                    
-                    sql = """
-update %(table)s 
-set pass = '%(pass)s', geo_extent = ST_GeomFromText('SRID=4326;POLYGON((%(poly)s))') 
-WHERE id = %(id)s;
-
-update %(table)s set orbit_position = 
-case 
-	when ST_Y(ST_Centroid(geo_extent))  >= 0 AND pass = 'ASCENDING' THEN 
-		ST_Y(ST_Centroid(geo_extent))
-	when ST_Y(ST_Centroid(geo_extent))  >= 0 AND pass = 'DESCENDING' THEN 
-		180 - ST_Y(ST_Centroid(geo_extent))
-	when ST_Y(ST_Centroid(geo_extent))  < 0 AND pass = 'ASCENDING' THEN 
-		360 + ST_Y(ST_Centroid(geo_extent))
-	when ST_Y(ST_Centroid(geo_extent))  < 0 AND pass = 'DESCENDING' THEN 
-		180 - ST_Y(ST_Centroid(geo_extent))
-	else
-		NULL
-end 
-WHERE id = %(id)s;
-""" % {'table': self.satimage_table, 'pass':footprint['pass'], 'poly': poly_sql, 'id': item['id']}
-
-        #            print sql
-                    cur.execute (sql)
-                    
-                # generate quicklook
-                image_name = item['name'].replace ('.N1', '-preview')
-                preview_file = os.path.join(os.path.join(archive_dir, '%s.tif' % image_name))
-                image.extract_quicklook(preview_file)
-                self._publish_image (item['name'], image_name, preview_file, 'PREVIEW', footprint['corners'])
-                
-                
-                # Check for intersections with AOIs
-                aois = self.find_intersections (name=item['name'], aoi=aoi)
-                if aois:
-                    for aoi in aois:
-                        bbox = self.aoi_footprint(aoi['aoi_name'])
-                        image.extract_fullres (bbox)
-                        image.geocorrect ()
-                        image.adjust_gain ()
-                        image_name = item['name'].replace ('.N1', '-%s' % aoi['aoi_name'])
-                        dest_file = os.path.join(os.path.join(archive_dir, '%s.tif' % image_name))
-                        image.extract_geotiff (dest_file)
-                        corners = image.extract_geotiff_footprint ()
-                        
-                        self._publish_image (item['name'], image_name, dest_file, 'GEOTIFF', corners)
+            logging.debug (footprint)
+            
+            if footprint:
+                self.footprints.write (item['id'], footprint['pass'], footprint['corners'])
                 
-            except Error as e:
-                logging.error (e)
-                status='ERR_PROCESSING'
+            # generate quicklook
+            image_name = item['name'].replace ('.N1', '-preview')
+            preview_file = os.path.join(os.path.join(archive_dir, '%s.tif' % image_name))
+            image.extract_quicklook(preview_file)
+            artifacts.append ({'name': image_name, 'filename': preview_file, 'type': 'PREVIEW', 'corners': footprint['corners']})
+            
+            
+            # Check for intersections with AOIs
+            aois = self.find_intersections (name=item['name'], aoi=aoi, item=item, corners=footprint['corners'])
+            bboxes = [(aoi['aoi_name'], self._clip_bbox (aoi['aoi_name'], footprint['corners'])) for aoi in aois]
+            if bboxes:
+                if getattr(settings, 'AOI_BATCHING', True):
+                    clusters = self._cluster_aois (bboxes)
+                else:
+                    clusters = [[b] for b in bboxes]
                 
-            self._update_image_status (status, item['id'])
-            if not name:
-                item = self._next (status='DOWNLOADED', new_status='PROCESSING')
+                workers = min(getattr(settings, 'AOI_WORKERS', 1), len(clusters))
+                if workers > 1:
+                    # each chain runs in its own work dir; the products of the chains that 
+                    # succeed are kept even if another one fails
+                    def extract (job):
+                        try:
+                            self._extract_aois (job[0], item, archive_dir, job[1], artifacts)
+                        except Error as e:
+                            return e
+                    jobs = [(image.branch(), cluster) for cluster in clusters]
+                    pool = ThreadPool(workers)
+                    try:
+                        errors = [e for e in pool.map (extract, jobs) if e]
+                    finally:
+                        pool.close ()
+                        pool.join ()
+                    if errors:
+                        raise errors[0]
+                else:
+                    for cluster in clusters:
+                        self._extract_aois (image, item, archive_dir, cluster, artifacts)
+            
+        except Error as e:
+            logging.error (e)
+            status='ERR_PROCESSING'
+            error = str(e)
+            
+        return status, error, artifacts
+    
+    # nearby AOIs share one fullres extraction of their combined bbox, and each AOI's geotiff 
+    # is cut out of the shared export
+    # each product is added to artifacts as soon as it is made
+    def _extract_aois (self, image, item, archive_dir, cluster, artifacts):
+        if len(cluster) > 1:
+            logging.info ('Extracting AOIs %s together' % ', '.join([name for name, bbox in cluster]))
+        image.extract_fullres (self._union_bbox ([bbox for name, bbox in cluster]))
+        image.geocorrect ()
+        image.adjust_gain ()
+        geotiff = image.export_geotiff ()
+        for aoi_name, bbox in cluster:
+            image_name = item['name'].replace ('.N1', '-%s' % aoi_name)
+            dest_file = os.path.join(os.path.join(archive_dir, '%s.tif' % image_name))
+            image.warp_geotiff (geotiff, dest_file, bbox if len(cluster) > 1 else None)
+            corners = image.extract_geotiff_footprint (dest_file)
+            
+            artifacts.append ({'name': image_name, 'filename': dest_file, 'type': 'GEOTIFF', 'corners': corners})
+    
+    # the bbox of the part of an AOI covered by the image footprint, plus AOI_CLIP_MARGIN 
+    # degrees to allow for error in the footprint, so BEST only extracts the overlap
+    # the AOI's rings from the catalogue are clipped to the (convex) footprint, so an AOI 
+    # whose bbox is much bigger than its shape isn't extracted where only the bbox overlaps
+    def _clip_bbox (self, aoi, corners):
+        bbox = self.aoi_footprint (aoi)
+        west, south = float(bbox['bbox_lng1']), float(bbox['bbox_lat2'])
+        east, north = float(bbox['bbox_lng2']), float(bbox['bbox_lat1'])
+        footprint = [(float(c['lng']), float(c['lat'])) for c in corners]
+        points = []
+        for ring in self.aois.get (aoi).get ('rings') or []:
+            points.extend (clip_to_convex (list(ring), footprint))
+        if not points:
+            points = clip_to_box (footprint, west, south, east, north)
+        if not points:
+            return bbox
+        
+        margin = getattr(settings, 'AOI_CLIP_MARGIN', 0.05)
+        clipped = {
+            'bbox_lat1': min(north, max([p[1] for p in points]) + margin),
+            'bbox_lng1': max(west, min([p[0] for p in points]) - margin),
+            'bbox_lat2': max(south, min([p[1] for p in points]) - margin),
+            'bbox_lng2': min(east, max([p[0] for p in points]) + margin),
+        }
+        logging.debug ('Clipped bounding box %s to %s' % (bbox, clipped))
+        return clipped
+    
+    # group (name, bbox) pairs into clusters that are cheaper to extract together
+    # an AOI joins a cluster when the bbox around both is no bigger than AOI_BATCH_SLACK times 
+    # their separate areas, so far apart AOIs never pull in the ocean between them
+    def _cluster_aois (self, bboxes):
+        slack = getattr(settings, 'AOI_BATCH_SLACK', 2.0)
+        clusters = []
+        for name, bbox in bboxes:
+            for cluster in clusters:
+                union = self._union_bbox ([b for n, b in cluster] + [bbox])
+                if self._bbox_area (union) <= slack * (self._bbox_area (self._union_bbox ([b for n, b in cluster])) + self._bbox_area (bbox)):
+                    cluster.append ((name, bbox))
+                    break
             else:
-                item = None
+                clusters.append ([(name, bbox)])
+        return clusters
+    
+    def _union_bbox (self, bboxes):
+        return {
+            'bbox_lat1': max([b['bbox_lat1'] for b in bboxes]),
+            'bbox_lng1': min([b['bbox_lng1'] for b in bboxes]),
+            'bbox_lat2': min([b['bbox_lat2'] for b in bboxes]),
+            'bbox_lng2': max([b['bbox_lng2'] for b in bboxes]),
+        }
+    
+    def _bbox_area (self, bbox):
+        return (bbox['bbox_lat1'] - bbox['bbox_lat2']) * (bbox['bbox_lng2'] - bbox['bbox_lng1'])
+    
+    def _s3_uri (self, source_image, filename):
+        return '%s%s' % (self._s3_path (source_image), os.path.basename(filename))
+    
+    # upload all of an image's artifacts at once, then record them
+    def _publish_artifacts (self, item, artifacts):
+        urls = self.s3Loader.put_files ([(a['filename'], self._s3_uri (item['name'], a['filename'])) for a in artifacts])
+        records = self._record_writer ()
+        for a, url in zip(artifacts, urls):
+            self._publish_image (item['name'], a['name'], a['filename'], a['type'], a['corners'], url, records)
+        records.flush ()
             
     def intersect(self, name=None, aoi=None):
         items = self.find_intersections (name, aoi)
@@ -1006,6 +3273,17 @@ WHERE id = %(id)s;
 #    image.extract_geotiff (tif_file)
 #    
     
+# body of each process --workers child: process images with a processor of its own
+def _process_worker (args):
+    aoi, auto_cleanup, debug = args
+    try:
+        processor = AsarProcessor (debug=debug)
+        return processor.process (aoi=aoi, auto_cleanup=auto_cleanup)
+    except Exception, e:
+        logging.exception ('Worker %s failed' % os.getpid())
+        return [{'name': 'worker %s' % os.getpid(), 'status': 'WORKER_FAILED', 'error': str(e)}]
+    
+    
 def main ():
 
     desc = "Tools for acquiring and processing ASAR satellite image files"
@@ -1015,15 +3293,33 @@ def main ():
     command is one of the following:
         scrape      
             scrape the rolling archive and add new images to the processing queue
+            use --full to ignore the listing cache
         download    
             download pending images in the queue
             use --name to process a specifc image
+            use --workers to set the number of concurrent downloads
         process     
             process dowloaded images - capture footprint and generate preview
             use --name to process a specifc image
+            use --workers to process images in several processes at once
         intersect     
             Find intersections between processed images and AOIs
             use --name to process a specifc image
+        pipeline
+            scrape, download, process and publish new images in one run, passing each 
+            image on to the next stage as soon as it is ready
+            use --workers to set the number of images processed at once
+        recover
+            return images left DOWNLOADING or PROCESSING by a dead worker to the queue
+        publish
+            publish images left in the publish queue, such as uploads waiting to be retried
+        footprint
+            read footprints from the headers of downloaded images that don't have one
+            use --name for a specific image or --full to rewrite them all
+        schema
+            add the lease columns and the indexes the queue and intersection queries need, 
+            then report missing indexes and table bloat
+            use --check to only report, or --partition to partition images by month
 """
     parser = OptionParser(description=desc, usage=usage)
 
@@ -1043,6 +3339,18 @@ def main ():
     parser.add_option("-c", "--nocleanup",
                           dest="autocleanup", action="store_false",default=True,
                           help="Suppress cleanup of temporary files on exit")
+    parser.add_option("-w", "--workers",
+                          dest="workers", type="int", metavar='N',
+                          help="Number of concurrent workers to use")
+    parser.add_option("-f", "--full",
+                          dest="full", action="store_true", default=False,
+                          help="Ignore the listing cache and re-scrape the full rolling archive listings, or rewrite all footprints")
+    parser.add_option("--check",
+                          dest="check", action="store_true", default=False,
+                          help="Report on the schema without changing it")
+    parser.add_option("--partition",
+                          dest="partition", action="store_true", default=False,
+                          help="Partition the image table by acquisition month")
 
                           
     (options, args) = parser.parse_args()
@@ -1056,16 +3364,27 @@ def main ():
 
     processor = AsarProcessor(debug= options.loglevel==logging.DEBUG)
     if command == 'scrape':
-        processor.scrape ()
+        processor.scrape (full = options.full)
     elif command == 'download':
-        processor.download (name = options.name)
+        processor.download (name = options.name, workers = options.workers)
     elif command == 'process':
         if options.aoi:
             processor.process_aoi (aoi=options.aoi)
         else:
-            processor.process (name = options.name, auto_cleanup = options.autocleanup)
+            processor.process (name = options.name, auto_cleanup = options.autocleanup, workers = options.workers)
     elif command == 'intersect':
         processor.intersect (name = options.name, aoi = options.aoi)
+    elif command == 'pipeline':
+        processor.pipeline (aoi = options.aoi, auto_cleanup = options.autocleanup, 
+            workers = options.workers, full = options.full)
+    elif command == 'recover':
+        processor.recover ()
+    elif command == 'publish':
+        processor.publish ()
+    elif command == 'footprint':
+        processor.footprint (name = options.name, full = options.full)
+    elif command == 'schema':
+        processor.schema (check = options.check, partition = options.partition)
     elif command == 'test':
         processor.test (options)
     else:
@@ -10,4 +10,78 @@ ARCHIVE_DIR = 'F:\\ASAR\\'
 MAX_DOWNLOAD = 2000
 MAX_PROCESS = 2000
 
-S3_CONFIG_FILE = '%ss3.cfg' % ARCHIVE_DIR
\ No newline at end of file
+S3_CONFIG_FILE = '%ss3.cfg' % ARCHIVE_DIR
+# seconds allowed for each rolling archive mirror to return its listing
+SCRAPE_TIMEOUT = 120
+
+# remembers the last listing from each mirror so unchanged listings are skipped
+SCRAPE_CACHE_FILE = '%sscrape-cache.json' % ARCHIVE_DIR
+
+# concurrent downloads, the limit for any one mirror, and the total rate in bytes/sec (0 = unlimited)
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_PER_HOST = 2
+DOWNLOAD_MAX_RATE = 0
+
+# seconds before a stalled download connection is dropped, and how many times to resume it
+DOWNLOAD_TIMEOUT = 60
+DOWNLOAD_RETRIES = 3
+
+# per-mirror throughput, latency and error rate used to choose where to download from
+MIRROR_HEALTH_FILE = '%smirror-health.json' % ARCHIVE_DIR
+
+# seconds between lease heartbeats, and seconds without one before a claimed image is requeued
+HEARTBEAT_INTERVAL = 60
+LEASE_TIMEOUT = 600
+
+# pipeline command: images waiting between stages, and images processed at once
+PIPELINE_QUEUE_SIZE = 2
+PIPELINE_PROCESS_WORKERS = 2
+
+# reuse BEST stage outputs when an image is processed again with the same parameters
+# (None disables the cache); the size limit in bytes, and the stages to cache (None = all)
+ARTIFACT_CACHE_DIR = '%scache' % ARCHIVE_DIR
+ARTIFACT_CACHE_MAX_BYTES = 10 * 1024 ** 3
+ARTIFACT_CACHE_STAGES = None
+
+# extract nearby AOIs from one image together; AOIs are grouped while the bbox around them 
+# is at most AOI_BATCH_SLACK times the area of their own bboxes
+AOI_BATCHING = True
+AOI_BATCH_SLACK = 2.0
+
+# AOI extractions from one image run at once, each in its own work dir
+AOI_WORKERS = 2
+
+# degrees added around the overlap of the image footprint and an AOI when extracting it
+AOI_CLIP_MARGIN = 0.05
+
+# seconds between checks of the AOI table for changes to the in-memory AOI catalogue
+AOI_REFRESH_INTERVAL = 300
+
+# parts of one large file, and separate files, uploaded to S3 at once, and retries per request
+S3_PART_WORKERS = 4
+S3_FILE_WORKERS = 4
+S3_RETRIES = 3
+
+# processed images wait here to be uploaded by PUBLISH_WORKERS background threads; an image 
+# becomes PUBLISHED once uploaded, or ERR_PUBLISHING after PUBLISH_RETRIES failed attempts
+PUBLISH_SPOOL_DIR = '%spublish-spool' % ARCHIVE_DIR
+PUBLISH_WORKERS = 2
+PUBLISH_RETRIES = 5
+
+# satimage_published rows written per statement
+PUBLISH_RECORD_BATCH = 500
+
+# footprints written per statement by the footprint command
+FOOTPRINT_BATCH = 500
+
+# idle database connections kept open for reuse; each thread using the database has its own 
+# connection (None sizes it from the worker settings)
+DB_POOL_SIZE = None
+
+# rows fetched at a time when streaming large query results
+DB_ITERSIZE = 2000
+
+# schema command: months of partitions created ahead of time, and the share of dead rows 
+# reported as bloat
+SCHEMA_PARTITION_MONTHS_AHEAD = 3
+SCHEMA_BLOAT_THRESHOLD = 0.2